@@ -0,0 +1,21 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils.convert import load_nii
+
+
+@pytest.mark.parametrize("image_class", [nib.Nifti1Image, nib.Nifti2Image])
+def test_load_nii_cache_hit_keeps_header_class(tmp_path, image_class):
+    data = np.arange(4 * 5 * 6, dtype=np.float32).reshape(4, 5, 6)
+    path = str(tmp_path / "volume.nii")
+    nib.save(image_class(data, np.diag([0.7, 0.8, 2.5, 1])), path)
+    cache_dir = str(tmp_path / "cache")
+
+    miss = load_nii(path, cache_dir=cache_dir)
+    hit = load_nii(path, cache_dir=cache_dir)
+
+    assert type(hit[2]) is type(miss[2])
+    assert hit[2].binaryblock == miss[2].binaryblock
+    np.testing.assert_array_equal(hit[0], miss[0])
+    np.testing.assert_array_equal(hit[1], miss[1])
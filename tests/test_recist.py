@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import pdist
+from skimage.draw import ellipse
+
+from utils.recist import calculate_diameter
+
+
+def _brute_force_diameter(binary_slice, spacing):
+    points = np.argwhere(binary_slice) * np.asarray(spacing)
+    return pdist(points).max() if len(points) > 1 else 0.0
+
+
+@pytest.mark.parametrize("spacing", [(0.7, 0.7), (0.8, 0.8), (0.68, 0.68), (0.6, 0.9)])
+def test_calculate_diameter_matches_brute_force_on_ellipses(spacing):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        mask = np.zeros((64, 64, 1), dtype=np.uint8)
+        rr, cc = ellipse(32, 32, rng.uniform(1, 25), rng.uniform(1, 25),
+                         shape=mask.shape[:2], rotation=rng.uniform(0, np.pi))
+        mask[rr, cc, 0] = 1
+        expected = _brute_force_diameter(mask[:, :, 0], spacing)
+        assert calculate_diameter(mask, 0, spacing=spacing) == pytest.approx(expected, rel=1e-9, abs=1e-9)
@@ -1,27 +1,49 @@
 __all__ = [
-    "load_dcm", "load_nii", "save_nii", "dcm2nii", "nii2niigz", "niigz2nii",
+    "load_dcm", "load_nii", "save_nii", "dcm2nii", "nii2niigz", "niigz2nii", "split_dcm_series", "batch_dcm2nii",
+    "LazyNiftiVolume", "LazyDicomVolume",
+    "file_fingerprint", "load_volume_cache", "save_volume_cache", "evict_cache",
+    "array_fingerprint", "load_transform_cache", "save_transform_cache",
+    "minmax", "normalize", "percentile_normalize", "window_bounds", "clip_window", "window_lut", "apply_window",
+    "multi_window", "WINDOWS",
     "confusion_matrix", "dice", "sensitivity", "precision", "recall", "f1_score", "fpr",
+    "multiclass_confusion_matrix", "class_metrics",
+    "ConfusionMatrixAccumulator", "ErrorAccumulator", "evaluate_nii_streaming", "evaluate_cohort",
+    "hausdorff_distance", "hd95", "assd", "nsd", "surface_metrics",
+    "lesion_overlap", "lesion_metrics",
     "ssim", "psnr", "mae", "mse", "rmse",
-    "search_files", "search", "split_path","Anonymized_header",
+    "search_files", "search", "split_path","Anonymized_header", "is_dicom_file", "scan_dicom", "query_dicom",
+    "anonymize_dicom",
     "forceAspect", "plot_3d", "get_quiver_plot", "animate_3d","norm","convert_window",
-    "preprocess","affine_registration","affine_transform", 
+    "preprocess","affine_registration","affine_transform", "roi_bbox", "batch_registration",
     "Lung_clip", "split_into_instances",  "calculate_volume", "find_instance_mask", "calculate_distance",
     "find_closest_coordinates", "select_target_lesion_fixed", "select_target_lesion_moved", "select_target_lesion_moving",
-    "calculate_diameter", "get_information",
+    "calculate_diameter", "get_information", "lesion_statistics", "relabel", "match_lesions",
     ]
 
+from .cache import file_fingerprint, load_volume_cache, save_volume_cache, evict_cache
+from .cache import array_fingerprint, load_transform_cache, save_transform_cache
+from .intensity import minmax, normalize, percentile_normalize, window_bounds, clip_window, window_lut
+from .intensity import apply_window, multi_window, WINDOWS
+
 from .file import search_files, search, split_path, Anonymized_header
+from .file import is_dicom_file, scan_dicom, query_dicom, anonymize_dicom
 from .plot import forceAspect, plot_3d, get_quiver_plot, animate_3d, convert_window
 
-from .convert import load_dcm, load_nii, save_nii, dcm2nii
+from .convert import load_dcm, load_nii, save_nii, dcm2nii, split_dcm_series, batch_dcm2nii
 from .convert import nii2niigz, niigz2nii
+from .convert import LazyNiftiVolume, LazyDicomVolume
 
 from .evaluate import confusion_matrix, dice, sensitivity, precision, recall, f1_score, fpr
 from .evaluate import ssim, psnr, mae, mse, rmse, norm
+from .evaluate import multiclass_confusion_matrix, class_metrics
+from .evaluate import ConfusionMatrixAccumulator, ErrorAccumulator, evaluate_nii_streaming
+from .evaluate import evaluate_cohort
+from .evaluate import hausdorff_distance, hd95, assd, nsd, surface_metrics
+from .evaluate import lesion_overlap, lesion_metrics
 
-from .registration import preprocess, affine_registration, affine_transform
+from .registration import preprocess, affine_registration, affine_transform, roi_bbox, batch_registration
 
 from .recist import Lung_clip, split_into_instances,  calculate_volume, find_instance_mask, calculate_distance
 from .recist import find_closest_coordinates, select_target_lesion_fixed, select_target_lesion_moved, select_target_lesion_moving
-from .recist import calculate_diameter, get_information
+from .recist import calculate_diameter, get_information, lesion_statistics, relabel, match_lesions
 
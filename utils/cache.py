@@ -0,0 +1,223 @@
+"""
+Log
+
+* Written by HongYongGi / email: hyg4438@gmail.com
+
+* Written date : 20261018
+
+
+# Description
+    * Persistent on-disk cache of decoded volumes
+    * Entries are keyed on the source files fingerprint (path, size, mtime)
+      and stored as .npy (memory-mapped copy-on-write on reload) + information.json
+    * Registration transforms are keyed on the content of the fixed / moving arrays
+      and stored as copies of the ANTs transform files + information.json
+    * Total size is capped, least recently used entries are evicted first
+      (the entry just written is never evicted, even if it alone exceeds the cap)
+
+"""
+
+import os, json, shutil, hashlib, time, uuid
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dicom_file_function')
+MAX_CACHE_BYTES   = 50 * 1024 ** 3   # 50 GB
+
+
+def file_fingerprint(files, *params):
+    """
+    Cache key of a list of source files
+
+    Args:
+        files (list): source file paths
+        params : extra loader parameters that change the decoded result
+
+    Returns:
+        key (str): hex digest of (path, size, mtime) of every file and params
+    """
+    digest = hashlib.sha1()
+    for file in sorted(files):
+        stat = os.stat(file)
+        digest.update(os.path.abspath(file).encode('utf-8', 'surrogateescape'))
+        digest.update(b'\0%d\0%d\0' % (stat.st_size, stat.st_mtime_ns))
+    digest.update(repr(params).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def array_fingerprint(arrays, *params):
+    """
+    Cache key of in-memory arrays (content hash)
+
+    Args:
+        arrays (list): numpy arrays
+        params : extra parameters that change the cached result
+
+    Returns:
+        key (str): blake2b hex digest of shape, dtype and bytes of every array and params
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.shape, array.dtype.str)).encode('utf-8'))
+        digest.update(memoryview(array).cast('B'))
+    digest.update(repr(params).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, file)) for file in os.listdir(entry_dir))
+
+
+def evict_cache(cache_dir = DEFAULT_CACHE_DIR, max_cache_bytes = None, keep = None):
+    """
+    Remove least recently used entries until the cache fits in max_cache_bytes
+
+    Args:
+        cache_dir (str): cache directory
+        max_cache_bytes (int): size cap in bytes (None : MAX_CACHE_BYTES)
+        keep (str): key that is never evicted (the entry just written)
+    """
+    if max_cache_bytes is None:
+        max_cache_bytes = MAX_CACHE_BYTES
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        try:
+            size = _entry_size(entry_dir)
+            total += size
+            if name != keep:
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+        except OSError:
+            continue
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+
+
+def load_volume_cache(key, cache_dir = DEFAULT_CACHE_DIR):
+    """
+    Load a cached volume (memory-mapped copy-on-write : in-place edits stay in memory, the cache file is unchanged)
+
+    Args:
+        key (str): cache key
+        cache_dir (str): cache directory
+
+    Returns:
+        (volume, information) or None if the key is not cached
+        volume (numpy.memmap): cached array (writable, copy-on-write)
+        information (dict): cached metadata
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry_dir, 'information.json')) as file:
+            information = json.load(file)
+        volume = np.load(os.path.join(entry_dir, 'volume.npy'), mmap_mode='c')
+    except (OSError, ValueError):
+        return None
+    # mark as recently used for LRU eviction
+    now = time.time()
+    try:
+        os.utime(entry_dir, (now, now))
+    except OSError:
+        pass
+    return volume, information
+
+
+def save_volume_cache(key, volume, information, cache_dir = DEFAULT_CACHE_DIR, max_cache_bytes = None):
+    """
+    Store a volume and its metadata in the cache (atomic, concurrent writers are safe)
+
+    Args:
+        key (str): cache key
+        volume (numpy.ndarray): array to cache
+        information (dict): json serializable metadata
+        cache_dir (str): cache directory
+        max_cache_bytes (int): size cap in bytes (None : MAX_CACHE_BYTES)
+    """
+    def write(temp_dir):
+        np.save(os.path.join(temp_dir, 'volume.npy'), np.asarray(volume))
+        with open(os.path.join(temp_dir, 'information.json'), 'w') as file:
+            json.dump(information, file)
+    _store_entry(key, write, cache_dir, max_cache_bytes)
+
+
+def _store_entry(key, write, cache_dir, max_cache_bytes):
+    """
+    Write an entry into a temp directory and rename it into place
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, key)
+    temp_dir = os.path.join(cache_dir, '.' + key + '.' + uuid.uuid4().hex)
+    os.makedirs(temp_dir)
+    try:
+        write(temp_dir)
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # another process already stored the same key
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    evict_cache(cache_dir, max_cache_bytes, keep=key)
+
+
+def load_transform_cache(key, cache_dir = DEFAULT_CACHE_DIR):
+    """
+    Load cached registration transforms
+
+    Args:
+        key (str): cache key
+        cache_dir (str): cache directory
+
+    Returns:
+        transforms (dict): fwdtransforms / invtransforms with stable paths, or None if the key is not cached
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry_dir, 'information.json')) as file:
+            information = json.load(file)
+    except (OSError, ValueError):
+        return None
+    transforms = {name: [os.path.join(entry_dir, file) for file in information[name]]
+                  for name in ('fwdtransforms', 'invtransforms')}
+    if not all(os.path.exists(path) for paths in transforms.values() for path in paths):
+        return None
+    now = time.time()
+    try:
+        os.utime(entry_dir, (now, now))
+    except OSError:
+        pass
+    return transforms
+
+
+def save_transform_cache(key, transforms, cache_dir = DEFAULT_CACHE_DIR, max_cache_bytes = None):
+    """
+    Copy registration transform files into the cache
+
+    Args:
+        key (str): cache key
+        transforms (dict): ants registration result (fwdtransforms / invtransforms file lists)
+        cache_dir (str): cache directory
+        max_cache_bytes (int): size cap in bytes (None : MAX_CACHE_BYTES)
+
+    Returns:
+        transforms (dict): fwdtransforms / invtransforms with stable paths in the cache 
+                           (None if the entry could not be stored)
+    """
+    names = {}
+    for path in transforms['fwdtransforms'] + transforms['invtransforms']:
+        names.setdefault(path, '%d_%s' % (len(names), os.path.basename(path)))
+
+    def write(temp_dir):
+        for path, name in names.items():
+            shutil.copyfile(path, os.path.join(temp_dir, name))
+        with open(os.path.join(temp_dir, 'information.json'), 'w') as file:
+            json.dump({name: [names[path] for path in transforms[name]]
+                       for name in ('fwdtransforms', 'invtransforms')}, file)
+    _store_entry(key, write, cache_dir, max_cache_bytes)
+    return load_transform_cache(key, cache_dir)
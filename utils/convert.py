@@ -17,44 +17,68 @@
 
 
 # Package import
-import os, glob, shutil
+import os, glob, shutil, gzip, csv, time, argparse
 import numpy as np
 import warnings
 warnings.filterwarnings('ignore')  
-import dicom2nifti
-import dicom2nifti.settings as settings
-settings.disable_validate_slice_increment()
 import nibabel as nib
 import pydicom
 from pydicom import dcmread
+from pydicom.valuerep import DSfloat
+from pydicom.multival import MultiValue
 
 from tqdm import tqdm
 import ipywidgets as widgets
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from .cache import file_fingerprint, load_volume_cache, save_volume_cache
 
 
 # Utils function
-def load_nii(path):
+def load_nii(path, lazy_flag = False, cache_dir = None):
     """
     # Description
         * Load NIFTI file
+        * lazy_flag returns a LazyNiftiVolume, voxels are read (memory-mapped for .nii) only when sliced
         
 
     Args:
         path (str): NIFTI file path
+        lazy_flag (bool): If True, return a LazyNiftiVolume instead of a float64 array
+        cache_dir (str): decoded volume cache directory (None : no cache), 
+                         a cached file is returned as a copy-on-write memory-mapped array
         
     Return :
-        nii (nibabel.nifti1.Nifti1Image): NIFTI file
+        nii (numpy.ndarray or LazyNiftiVolume): NIFTI array (axis 0 and 1 swapped)
         affine (numpy.ndarray): affine matrix
         header (dict): header information
     
     """
     
+    if lazy_flag:
+        nii = LazyNiftiVolume(path)
+        return nii, nii.affine, nii.header
+    
+    if cache_dir is not None:
+        key = file_fingerprint([path], 'load_nii')
+        cached = load_volume_cache(key, cache_dir)
+        if cached is not None:
+            nii, information = cached
+            header_class = getattr(nib, information.get('header_class', 'Nifti1Header'))
+            header = header_class(binaryblock=bytes.fromhex(information['header']))
+            return nii, np.array(information['affine']), header
+    
     nii = nib.load(path)
     affine = nii.affine
     header = nii.header
     nii = nii.get_fdata()
     nii = np.swapaxes(nii,0,1)
+    
+    if cache_dir is not None and type(header) in (nib.Nifti1Header, nib.Nifti2Header):
+        information = {'affine' : affine.tolist(), 'header' : header.binaryblock.hex(),
+                       'header_class' : type(header).__name__}
+        save_volume_cache(key, nii, information, cache_dir)
     return nii, affine, header
 
 def save_nii(array, save_path, header = None , affine = np.eye(4)):
@@ -81,81 +105,565 @@ def save_nii(array, save_path, header = None , affine = np.eye(4)):
     
 
 
-def load_dcm(dicom_dir, information_flag = False):
+def _read_dicom_header(dicom_file):
     """
-    
     # Description
-        * Load DICOM file
+        * Read only the header of one DICOM file (stop before pixel data)
 
     Args:
-        dicom_dir (str): DICOM directory path
-        information_flag (bool): If True, return information of DICOM file
-        
+        dicom_file (str): DICOM file path
+
     Return :
-        if information_flag is True:
-            dicom array, SeriesDescription, SliceThickness, PixelSpacing
-        
-        information_flag is False:
-            dicom array
-        
+        dicom (pydicom.dataset.FileDataset): DICOM header, None if the file is not an image slice
+    """
+    try:
+        dicom = dcmread(dicom_file, stop_before_pixels=True, force=True)
+    except Exception:
+        return None
+    # dose reports, structured reports and non DICOM files have no image matrix
+    if 'Rows' not in dicom or 'Columns' not in dicom:
+        return None
+    return dicom
+
+
+def _decode_dicom_file(dicom_file):
+    """
+    # Description
+        * Read one DICOM file and decode its pixel data
+
+    Args:
+        dicom_file (str): DICOM file path
+
+    Return :
+        pixel (numpy.ndarray): decoded pixel array
+    """
+    return dcmread(dicom_file, force=True).pixel_array
+
+
+def _rescale_dtype(dicoms):
+    """
+    # Description
+        * Choose the output dtype of a DICOM series from its rescale parameters
+        * int16 HU when RescaleSlope/Intercept are integral, float32 otherwise
+        * The int16 range is checked on SmallestImagePixelValue / LargestImagePixelValue when every
+          header has them (int32 if they do not fit), otherwise on the BitsStored range ;
+          when only BitsStored is known and it does not fit, int16 is provisional and 
+          the decoded slices are checked (see _read_dcm_volume)
+
+    Args:
+        dicoms (list): DICOM headers of one series
+
+    Return :
+        dtype (numpy.dtype): output dtype
+        checked (bool): False if int16 was chosen without a guaranteed range
+    """
+    slopes = np.array([float(dicom.get('RescaleSlope', 1)) for dicom in dicoms])
+    intercepts = np.array([float(dicom.get('RescaleIntercept', 0)) for dicom in dicoms])
+    if not (np.all(slopes == np.round(slopes)) and np.all(intercepts == np.round(intercepts))):
+        return np.dtype(np.float32), True
+
+    if all('SmallestImagePixelValue' in dicom and 'LargestImagePixelValue' in dicom for dicom in dicoms):
+        pixel_min = np.array([float(dicom.SmallestImagePixelValue) for dicom in dicoms])
+        pixel_max = np.array([float(dicom.LargestImagePixelValue) for dicom in dicoms])
+        range_flag = True
+    else:
+        bits = int(dicoms[0].get('BitsStored', 16))
+        if int(dicoms[0].get('PixelRepresentation', 0)) == 1:
+            pixel_min, pixel_max = -(2 ** (bits - 1)), 2 ** (bits - 1) - 1
+        else:
+            pixel_min, pixel_max = 0, 2 ** bits - 1
+        range_flag = False
+    values = np.concatenate([slopes * pixel_min + intercepts, slopes * pixel_max + intercepts])
+    int16 = np.iinfo(np.int16)
+    if values.min() >= int16.min and values.max() <= int16.max:
+        return np.dtype(np.int16), True
+    if range_flag:
+        return np.dtype(np.int32), True
+    # worst case of BitsStored does not fit, real CT values almost always do
+    return np.dtype(np.int16), False
+
+
+class _RangeOverflow(Exception):
+    """
+    A decoded slice does not fit the provisional int16 output
+    """
+
+
+def _write_slice(image, index, pixel, slope, intercept, range_check = False):
+    """
+    # Description
+        * Rescale one decoded slice and write it into the preallocated volume
+        * range_check raises _RangeOverflow instead of wrapping values that do not fit an integer volume
+    """
+    slope, intercept = float(slope), float(intercept)
+    if image.dtype.kind == 'f':
+        value = pixel.astype(image.dtype)
+    elif slope.is_integer() and intercept.is_integer():
+        value = pixel.astype(np.int32)
+        slope, intercept = int(slope), int(intercept)
+    else:
+        value = pixel.astype(np.float64)
+    if slope != 1:
+        value *= slope
+    if intercept != 0:
+        value += intercept
+    if range_check and image.dtype.kind in 'iu':
+        limits = np.iinfo(image.dtype)
+        if value.min() < limits.min or value.max() > limits.max:
+            raise _RangeOverflow()
+    image[:, :, index] = value
+
+
+def _parallel_map(function, items, workers = None, process_flag = False):
+    """
+    # Description
+        * Map function over items with a bounded thread/process pool
+        * workers None or 1 runs serially in the calling thread
+
+    Args:
+        function (callable): function to apply (must be picklable if process_flag is True)
+        items (list): inputs
+        workers (int): number of workers
+        process_flag (bool): If True, use processes instead of threads
+
+    Return :
+        results (list): results in the same order as items
+    """
+    if workers is None or workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    if process_flag:
+        chunksize = max(1, len(items) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(function, items, chunksize=chunksize))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+
+def _dicom_file_list(dicom_dir):
+    """
+    # Description
+        * List the candidate DICOM files of a directory (sorted by file name)
     """
-    
-    
     dicom_files = glob.glob(dicom_dir + '/*')
     if len(dicom_files) == 0 : 
         dicom_files = glob.glob(dicom_dir + '/*.DCM')
-    elif len(dicom_files) == 0 : 
-        dicom_files = glob.glob(dicom_dir + '/*')
+    dicom_files = [dicom_file for dicom_file in dicom_files if os.path.isfile(dicom_file)]
+    dicom_files.sort()
+    return dicom_files
+
+
+def _sort_dicom_headers(series):
+    """
+    # Description
+        * Sort (file, header) pairs of one series along the slice direction
+        * ImagePositionPatient projected on the slice normal, 
+          then SliceLocation, then InstanceNumber
+
+    Args:
+        series (list): list of (dicom file, dicom header)
+
+    Return :
+        series (list): sorted list of (dicom file, dicom header)
+    """
+    headers = [dicom for _, dicom in series]
+    try:
+        orientation = np.array(headers[0].ImageOrientationPatient, dtype=np.float64)
+        normal = np.cross(orientation[:3], orientation[3:])
+        positions = [np.dot(np.array(dicom.ImagePositionPatient, dtype=np.float64), normal) for dicom in headers]
+    except Exception:
+        try:
+            positions = [float(dicom.SliceLocation) for dicom in headers]
+        except Exception:
+            try:
+                positions = [int(dicom.InstanceNumber) for dicom in headers]
+            except Exception:
+                return series
+    slice_sorts = np.argsort(positions, kind='stable')
+    return [series[slice_sort] for slice_sort in slice_sorts]
+
+
+def split_dcm_series(dicom_dir, workers = None, process_flag = False):
+    """
+    # Description
+        * Header only pass over a DICOM directory
+        * Group the image files by SeriesInstanceUID and ImageOrientationPatient
+          and sort every group by ImagePositionPatient
+
+    Args:
+        dicom_dir (str): DICOM directory path
+        workers (int): number of parallel header readers (None : serial)
+        process_flag (bool): If True, use a process pool instead of a thread pool
+
+    Return :
+        series (dict): series key -> sorted list of (dicom file, dicom header)
+                       series key is SeriesInstanceUID 
+                       ('SeriesInstanceUID#n' when one UID has several orientations)
+
+    example :
+        >>> series = split_dcm_series('C:/Users/.../dicom/')
+        >>> for series_uid, slices in series.items():
+        ...     print(series_uid, slices[0][1].SeriesDescription, len(slices))
+    """
+    dicom_files = _dicom_file_list(dicom_dir)
+    headers = _parallel_map(_read_dicom_header, dicom_files, workers, process_flag)
+
+    groups = {}
+    for dicom_file, dicom in zip(dicom_files, headers):
+        if dicom is None:
+            continue
+        series_uid = str(dicom.get('SeriesInstanceUID', ''))
+        try:
+            orientation = tuple(np.round(np.array(dicom.ImageOrientationPatient, dtype=np.float64), 3))
+        except Exception:
+            orientation = None
+        groups.setdefault((series_uid, orientation), []).append((dicom_file, dicom))
+
+    series = {}
+    uid_counts = {}
+    for series_uid, _ in groups:
+        uid_counts[series_uid] = uid_counts.get(series_uid, 0) + 1
+    uid_index = {}
+    for (series_uid, orientation), group in groups.items():
+        if uid_counts[series_uid] > 1:
+            uid_index[series_uid] = uid_index.get(series_uid, 0) + 1
+            key = series_uid + '#' + str(uid_index[series_uid])
+        else:
+            key = series_uid
+        series[key] = _sort_dicom_headers(group)
+    return series
+
+
+def _select_dcm_series(dicom_dir, series_uid = None, workers = None, process_flag = False):
+    """
+    # Description
+        * Pick one series of a DICOM directory from the header only pass
+        * series_uid None selects the series with the most slices
+
+    Return :
+        dicom_files (list): sorted DICOM file paths of the series
+        dicoms (list): sorted DICOM headers of the series
+    """
+    series = split_dcm_series(dicom_dir, workers, process_flag)
+    if series_uid is not None:
+        series = {key : value for key, value in series.items() 
+                  if key == series_uid or key.split('#')[0] == series_uid}
+    if len(series) == 0:
+        raise ValueError("No DICOM image series found : " + str(dicom_dir))
+    selected = max(series.values(), key=len)
+    dicom_files = [dicom_file for dicom_file, _ in selected]
+    dicoms = [dicom for _, dicom in selected]
+    return dicom_files, dicoms
+
+
+def _dcm_affine(dicoms):
+    """
+    # Description
+        * NIFTI affine of a DICOM series built from the headers
+          (ImagePositionPatient, ImageOrientationPatient, PixelSpacing)
+        * Same convention as dicom2nifti (reorient_nifti=False), 
+          slices ordered along the patient axis with the largest extent
+
+    Args:
+        dicoms (list): DICOM headers of one series
+
+    Return :
+        affine (numpy.ndarray): 4x4 affine matrix
+    """
+    positions = np.array([np.array(dicom.ImagePositionPatient, dtype=np.float64) for dicom in dicoms])
+    axis = int(np.argmax(positions.max(axis=0) - positions.min(axis=0)))
+    positions = positions[np.argsort(positions[:, axis], kind='stable')]
+
+    orientation = np.array(dicoms[0].ImageOrientationPatient, dtype=np.float64)
+    row_cosine, column_cosine = orientation[:3], orientation[3:]
+    delta_r = float(dicoms[0].PixelSpacing[0])
+    delta_c = float(dicoms[0].PixelSpacing[1])
+
+    if len(dicoms) == 1:
+        step = - np.cross(row_cosine, column_cosine) * float(dicoms[0].get('SliceThickness', 1))
     else:
-        pass
+        step = (positions[-1] - positions[0]) / (len(dicoms) - 1)
+
+    affine = np.array(
+        [[-row_cosine[0] * delta_c, -column_cosine[0] * delta_r, -step[0], -positions[0][0]],
+         [-row_cosine[1] * delta_c, -column_cosine[1] * delta_r, -step[1], -positions[0][1]],
+         [ row_cosine[2] * delta_c,  column_cosine[2] * delta_r,  step[2],  positions[0][2]],
+         [0, 0, 0, 1]])
+    return affine
+
+
+def _dcm_flipflag(dicoms):
+    """
+    # Description
+        * Orientation flags of a sorted DICOM series (see load_dcm)
+
+    Return :
+        flipflag (int): 1-slope flip 2-orientation flip 3-normal
+        z_flip (bool): slice axis is reversed
+        row_flip (bool): row axis is reversed
+    """
+    slope = np.float32(dicoms[min(15, len(dicoms) - 1)].ImagePositionPatient[2]) - \
+            np.float32(dicoms[0].ImagePositionPatient[2])
+    orientation = np.float32(dicoms[0].ImageOrientationPatient[4])    
     
-    dicom_files.sort()
+    if slope < 0:
+        flipflag = 1 # enforce feet first axially
+    if orientation < 0:
+        flipflag = 2 # enforce supine orientation
+    if (slope >= 0) and (orientation >= 0):
+        flipflag = 3
+    return flipflag, bool(slope < 0), bool(orientation < 0)
+
+
+def _normalize_key(key, ndim):
+    """
+    # Description
+        * Expand an index key (int, slice, Ellipsis) to one entry per axis
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(item is Ellipsis for item in key):
+        position = [item is Ellipsis for item in key].index(True)
+        fill = (slice(None),) * (ndim - len(key) + 1)
+        key = key[:position] + fill + key[position + 1:]
+    key = key + (slice(None),) * (ndim - len(key))
+    for item in key:
+        if not isinstance(item, (slice, int, np.integer)):
+            raise IndexError("Lazy volumes support only int, slice and Ellipsis indexing")
+    return key
+
+
+class LazyNiftiVolume:
+    """
+    # Description
+        * Lazy NIFTI volume, same axis convention as load_nii (axis 0 and 1 swapped)
+        * shape, spacing and affine are available immediately, 
+          voxels are read through the nibabel array proxy (memory-mapped for uncompressed .nii)
     
-    dicoms = [dcmread(dicom_file,force=True) for dicom_file in dicom_files]
+    Args:
+        path (str): NIFTI file path
+        
+    example :
+        >>> volume, affine, header = load_nii('C:/Users/.../ct.nii', lazy_flag=True)
+        >>> axial = volume[:, :, 100]
+        >>> slab  = volume[:, :, 100:110]
+    """
     
-    # 보통은 파일명으로 정렬되어 있지만, 그렇지 않은 경우가 있어서 정렬
-    # sort dicoms by slices
-    try: 
-        slice_sorts = np.argsort([dicom.SliceLocation for dicom in dicoms])
-        dicoms = [dicoms[slice_sort] for slice_sort in slice_sorts]    
-    except:
-        pass
+    def __init__(self, path):
+        image = nib.load(path)
+        self.path = path
+        self.affine = image.affine
+        self.header = image.header
+        self._dataobj = image.dataobj
+        shape = list(image.shape)
+        shape[0], shape[1] = shape[1], shape[0]
+        self.shape = tuple(shape)
+        zooms = list(self.header.get_zooms())
+        zooms[0], zooms[1] = zooms[1], zooms[0]
+        self.spacing = tuple(float(zoom) for zoom in zooms[:3])
+        self.dtype = self.header.get_data_dtype()
+        self.ndim = len(self.shape)
+        
+    def __getitem__(self, key):
+        key = _normalize_key(key, self.ndim)
+        data = self._dataobj[(key[1], key[0]) + key[2:]]
+        if isinstance(key[0], slice) and isinstance(key[1], slice):
+            data = np.swapaxes(data, 0, 1)
+        return data
     
+    def __array__(self, dtype = None, copy = None):
+        data = np.swapaxes(np.asanyarray(self._dataobj), 0, 1)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
 
+
+class LazyDicomVolume:
+    """
+    # Description
+        * Lazy DICOM volume, same array as load_dcm (rows, cols, slices) with the flipflag flips
+        * shape, spacing and affine are available immediately from the headers,
+          only the slices that are indexed are read and decoded
+        
+    Args:
+        dicom_files (list): sorted DICOM file paths of one series
+        dicoms (list): sorted DICOM headers of one series
+        dtype (numpy.dtype): output dtype (None : same rule as load_dcm, int32 when the
+                             int16 range is not guaranteed by the headers)
+        workers (int): number of parallel decoders for slabs (None : serial)
+        
+    example :
+        >>> volume, flipflag = load_dcm('C:/Users/.../dicom/', lazy_flag=True)
+        >>> axial = volume[:, :, 100]
+    """
     
+    def __init__(self, dicom_files, dicoms, dtype = None, workers = None):
+        self.dicom_files = dicom_files
+        self.dicoms = dicoms
+        if dtype is None:
+            # slices are decoded on demand, so a provisional int16 cannot be checked up front
+            dtype, checked = _rescale_dtype(dicoms)
+            dtype = dtype if checked else np.int32
+        self.dtype = np.dtype(dtype)
+        self.workers = workers
+        self.flipflag, self._z_flip, self._row_flip = _dcm_flipflag(dicoms)
+        self.shape = (int(dicoms[0].Rows), int(dicoms[0].Columns), len(dicoms))
+        self.ndim = 3
+        self.affine = _dcm_affine(dicoms)
+        if len(dicoms) > 1:
+            slice_spacing = float(np.linalg.norm(self.affine[:3, 2]))
+        else:
+            slice_spacing = float(dicoms[0].get('SliceThickness', 1))
+        self.spacing = (float(dicoms[0].PixelSpacing[0]), float(dicoms[0].PixelSpacing[1]), slice_spacing)
+        
+    def _read(self, indices):
+        image = np.empty(self.shape[:2] + (len(indices),), dtype=self.dtype)
+        def fill_slice(position):
+            index = indices[position]
+            pixel = _decode_dicom_file(self.dicom_files[index])
+            _write_slice(image, position, pixel, 
+                         self.dicoms[index].get('RescaleSlope', 1), self.dicoms[index].get('RescaleIntercept', 0))
+        _parallel_map(fill_slice, list(range(len(indices))), self.workers)
+        if self._row_flip:
+            image = np.flip(image, 0)
+        return image
+        
+    def __getitem__(self, key):
+        key = _normalize_key(key, self.ndim)
+        order = np.arange(self.shape[2])
+        if self._z_flip:
+            order = order[::-1]
+        indices = np.atleast_1d(order[key[2]])
+        data = self._read(indices)[key[0], key[1]]
+        if not isinstance(key[2], slice):
+            data = data[..., 0]
+        return data
+    
+    def __array__(self, dtype = None, copy = None):
+        data = self[:, :, :]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+def _read_dcm_volume(dicom_files, dicoms, dtype = None, workers = None, process_flag = False, range_check = False):
+    """
+    # Description
+        * Decode a sorted DICOM series into one preallocated (rows, cols, slices) volume
+        * Orientation flips are returned as views
+        * A provisional int16 dtype (see _rescale_dtype) is checked slice by slice 
+          and the series is decoded again as int32 only if a slice overflows
+
+    Return :
+        image (numpy.ndarray): DICOM array
+        flipflag (int): orientation flag (see load_dcm)
+    """
+    if dtype is None:
+        dtype, checked = _rescale_dtype(dicoms)
+        if not checked:
+            try:
+                return _read_dcm_volume(dicom_files, dicoms, dtype, workers, process_flag, range_check = True)
+            except _RangeOverflow:
+                # real values do not fit int16
+                return _read_dcm_volume(dicom_files, dicoms, np.int32, workers, process_flag)
+    slopes = [dicom.get('RescaleSlope', 1) for dicom in dicoms]
+    intercepts = [dicom.get('RescaleIntercept', 0) for dicom in dicoms]
+    
+    image = np.empty((int(dicoms[0].Rows), int(dicoms[0].Columns), len(dicoms)), dtype=dtype)
+    
+    if process_flag and workers is not None and workers > 1:
+        chunksize = max(1, len(dicom_files) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pixels = executor.map(_decode_dicom_file, dicom_files, chunksize=chunksize)
+            for index, pixel in enumerate(pixels):
+                _write_slice(image, index, pixel, slopes[index], intercepts[index], range_check)
+    else:
+        def fill_slice(index):
+            pixel = _decode_dicom_file(dicom_files[index])
+            _write_slice(image, index, pixel, slopes[index], intercepts[index], range_check)
+        _parallel_map(fill_slice, list(range(len(dicom_files))), workers)
     
-    try :
-        RescaleSlope = dicoms[0].RescaleSlope
-        RescaleIntercept = dicoms[0].RescaleIntercept
-    except: 
-        RescaleSlope = 1
-        RescaleIntercept = 0
-    try: 
+    flipflag, z_flip, row_flip = _dcm_flipflag(dicoms)
+    if z_flip:
+        image = np.flip(image, -1)  # enforce feet first axially
+    if row_flip:
+        image = np.flip(image, 0)  # enforce supine orientation
+    return image, flipflag
+
+
+def load_dcm(dicom_dir, information_flag = False, workers = None, process_flag = False, series_uid = None, 
+             dtype = None, lazy_flag = False, cache_dir = None):
+    """
     
-        image  = np.array([dicom.pixel_array * RescaleSlope + RescaleIntercept for dicom in dicoms])
-        image  = np.transpose(image, axes=(1,2,0))
-        
+    # Description
+        * Load DICOM file
+        * Headers are read first (without pixel data) and grouped by series,
+          pixel data is decoded only for the selected series
+        * workers > 1 reads and decodes the slices in parallel
+        * Slices are rescaled straight into one preallocated (rows, cols, slices) volume,
+          orientation flips are returned as views
+
+    Args:
+        dicom_dir (str): DICOM directory path
+        information_flag (bool): If True, return information of DICOM file
+        workers (int): number of parallel readers (None : serial)
+        process_flag (bool): If True, use a process pool instead of a thread pool
+        series_uid (str): SeriesInstanceUID (or split_dcm_series key) to load, 
+                          None loads the series with the most slices
+        dtype (numpy.dtype): output dtype, None : int16 HU when RescaleSlope/Intercept are integral
+                             (int32 only if the real pixel range does not fit), float32 otherwise
+                             (cast int16 with astype(np.float32) before passing it to ANTsPy from_numpy 
+                              directly, registration.py helpers already do)
+        lazy_flag (bool): If True, return a LazyDicomVolume that decodes slices on demand
+        cache_dir (str): decoded volume cache directory (None : no cache), 
+                         keyed on the file paths, sizes and mtimes, 
+                         a cached series is returned as a copy-on-write memory-mapped array
+                         (ignored with lazy_flag)
         
+    Return :
+        if information_flag is True:
+            dicom array, SeriesDescription, SliceThickness, PixelSpacing
         
-        slope = np.float32(dicoms[15].ImagePositionPatient[2]) - \
-                np.float32(dicoms[0].ImagePositionPatient[2])
-        orientation = np.float32(dicoms[0].ImageOrientationPatient[4])    
+        information_flag is False:
+            dicom array
         
+    """
+    
+    if cache_dir is not None and not lazy_flag:
+        key = file_fingerprint(_dicom_file_list(dicom_dir), 'load_dcm', series_uid, 
+                               None if dtype is None else np.dtype(dtype).str)
+        cached = load_volume_cache(key, cache_dir)
+        if cached is not None:
+            image, information = cached
+            if information_flag==True : 
+                # same types as the headers of a cache miss (DS / MultiValue of DS)
+                thickness = information['thickness']
+                thickness = None if thickness is None else DSfloat(thickness)
+                spacing   = MultiValue(DSfloat, information['spacing'])
+                return image, information['flipflag'], information['Seriesdesc'], thickness, spacing
+            return image, information['flipflag']
+    
+    try: 
+        dicom_files, dicoms = _select_dcm_series(dicom_dir, series_uid, workers, process_flag)
         
-        if slope < 0:
-            image = np.flip(image, -1)  # enforce feet first axially
-            flipflag = 1
-        if orientation < 0:
-            image = np.flip(image, 0)  # enforce supine orientation
-            flipflag = 2
-            
-        if (slope >= 0) and (orientation >= 0):
-            flipflag = 3
+        if lazy_flag:
+            image = LazyDicomVolume(dicom_files, dicoms, dtype, workers)
+            flipflag = image.flipflag
+        else:
+            image, flipflag = _read_dcm_volume(dicom_files, dicoms, dtype, workers, process_flag)
 
         
+        if cache_dir is not None and not lazy_flag:
+            thickness = dicoms[0].get('SliceThickness', None)
+            information = {'flipflag'   : flipflag, 
+                           'Seriesdesc' : str(dicoms[0].get('SeriesDescription', '')),
+                           'thickness'  : None if thickness is None else str(thickness),
+                           'spacing'    : [str(value) for value in dicoms[0].PixelSpacing]}
+            save_volume_cache(key, image, information, cache_dir)
+        
         if information_flag==True : 
-            Seriesdesc   = dicoms[0].SeriesDescription
-            thickness    = dicoms[0].SliceThickness
+            Seriesdesc   = str(dicoms[0].get('SeriesDescription', ''))
+            thickness    = dicoms[0].get('SliceThickness', None)
             spacing      = dicoms[0].PixelSpacing   
                     
             
@@ -164,27 +672,34 @@ def load_dcm(dicom_dir, information_flag = False):
             return image, flipflag
     
     
-    except: 
-        print("Fail to load dicom directory : ", dicom_dir)
+    except Exception as error: 
+        print("Fail to load dicom directory : ", dicom_dir, error)
         flipflag =0
         return 0, flipflag
 
     
-def dcm2nii(ref_dicom_dir, save_nii_dir, file_name, volume, flip_flag = 1):
+def dcm2nii(ref_dicom_dir, save_nii_dir, file_name, volume, flip_flag = 1, 
+            affine = None, series_uid = None, workers = None):
     """
     
     # Description
         * Convert DICOM to NIFTI file
+        * The affine is built from the DICOM headers (header only read, no pixel decoding, 
+          no temporary NIFTI file), so several conversions can run in parallel in one directory
         
     Args:
         ref_dicom_dir (str): Target convert DICOM directory
         save_nii_dir (str): Save NIFTI directory 
         file_name (file name ): Save NIFTI file name(nii or nii.gz format)
-        volume (array): 3D CT array
+        volume (array): 3D CT array (or LazyDicomVolume from load_dcm)
         flip_flag : 1-normal 2-slope flip 3-orientation flip
+        affine (numpy.ndarray): NIFTI affine, None : built from the headers of ref_dicom_dir
+                                (taken from volume.affine for a LazyDicomVolume)
+        series_uid (str): series of ref_dicom_dir to use (see load_dcm)
+        workers (int): number of parallel header readers (None : serial)
         
     Returns : 
-        save_array : _description_
+        save_path (str): saved NIFTI file path
         
     example :
         >>> array = np.zeros((512,512,512))
@@ -194,17 +709,14 @@ def dcm2nii(ref_dicom_dir, save_nii_dir, file_name, volume, flip_flag = 1):
         >>> dcm2nii(ref_dicom_dir, save_nii_dir, file_name, volume)
     
     """    
-    try: 
-        os.makedirs(save_nii_dir)
-    except:
-        pass
+    os.makedirs(save_nii_dir, exist_ok=True)
     
-    dicom2nifti.dicom_series_to_nifti(ref_dicom_dir, 
-                                      save_nii_dir + 'temp.nii', 
-                                      reorient_nifti=False)
-    temp   = nib.load(save_nii_dir + 'temp.nii')
-    header = temp.header
-    affine = temp.affine
+    if affine is None and isinstance(volume, LazyDicomVolume):
+        affine = volume.affine
+    if affine is None:
+        _, dicoms = _select_dcm_series(ref_dicom_dir, series_uid, workers)
+        affine = _dcm_affine(dicoms)
+    volume = np.asarray(volume)
     
     
     if flip_flag == 1:
@@ -215,9 +727,11 @@ def dcm2nii(ref_dicom_dir, save_nii_dir, file_name, volume, flip_flag = 1):
         save_format =np.flip(np.flip(np.transpose(volume, (1,0,2)), 0),1)
         
     
-    save_nii_image = nib.Nifti1Image(save_format, affine, header)
-    nib.save(save_nii_image, save_nii_dir + '/' + file_name)
-    os.remove(save_nii_dir + 'temp.nii')    
+    save_nii_image = nib.Nifti1Image(save_format, affine)
+    save_nii_image.header.set_xyzt_units(2)  # mm
+    save_path = save_nii_dir + '/' + file_name
+    nib.save(save_nii_image, save_path)
+    return save_path
 
 
 
@@ -243,51 +757,209 @@ def dcm2nii(ref_dicom_dir, save_nii_dir, file_name, volume, flip_flag = 1):
 
     
     
-def nii2niigz(nii_path) : 
+def _gzip_member(chunk, compresslevel):
+    """
+    # Description
+        * Compress one block as an independent gzip member (zlib releases the GIL)
+    """
+    return gzip.compress(chunk, compresslevel=compresslevel, mtime=0)
+
+
+def nii2niigz(nii_path, compresslevel = 6, workers = None, chunk_size = 16 * 1024 ** 2) : 
     """
     # Description
         * Convert NIFTI file to NIFTI GZ file
+        * The file is streamed block by block, header, dtype and scaling are kept as they are on disk
+        * workers > 1 compresses the blocks in parallel as concatenated gzip members
+          (still a standard .nii.gz readable by nibabel / gzip)
 
     Args:
         nii_path (str): NIFTI file path
+        compresslevel (int): gzip compression level (1 fastest - 9 smallest)
+        workers (int): number of compression threads (None : single gzip stream)
+        chunk_size (int): block size in bytes
         
     Returns:
         niigz_path (str): NIFTI GZ file path
     
     """
     
-    nii = nib.load(nii_path)
-    affine = nii.affine
-    header = nii.header
-    nii = nii.get_fdata()
-    nii_image = nib.Nifti1Image(nii, affine, header)
     save_path = nii_path+ '.gz' 
-    nib.save(nii_image, save_path)
+    with open(nii_path, 'rb') as source:
+        if workers is None or workers <= 1:
+            with gzip.open(save_path, 'wb', compresslevel=compresslevel) as target:
+                shutil.copyfileobj(source, target, chunk_size)
+            return save_path
+        
+        with open(save_path, 'wb') as target, ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                pending.append(executor.submit(_gzip_member, chunk, compresslevel))
+                # bound the number of blocks held in memory
+                while len(pending) >= workers * 2:
+                    target.write(pending.pop(0).result())
+            for future in pending:
+                target.write(future.result())
     return save_path
 
 
 
-def niigz2nii(niigz_path):
+def niigz2nii(niigz_path, chunk_size = 16 * 1024 ** 2):
     """
     # Description
         * Convert NIFTI GZ file to NIFTI file
+        * The file is decompressed as a stream, header, dtype and scaling are kept as they are on disk
         
 
     Args:
         niigz_path (str): NIFTI GZ file path
+        chunk_size (int): block size in bytes
     Returns:
         nii_path (str): NIFTI file path
 
     """
 
-    nii = nib.load(niigz_path)
-    affine = nii.affine
-    header = nii.header
-    nii = nii.get_fdata()
-    nii_image = nib.Nifti1Image(nii, affine, header)
     save_path = niigz_path[:-3]
-    nib.save(nii_image, save_path)
+    with gzip.open(niigz_path, 'rb') as source, open(save_path, 'wb') as target:
+        shutil.copyfileobj(source, target, chunk_size)
     return save_path
 
-    
-    
+
+
+MANIFEST_FIELDS = ['source', 'series_uid', 'description', 'output', 'shape', 'spacing', 
+                   'read_time', 'write_time', 'total_time', 'error']
+
+
+def _convert_dcm_dir(dicom_dir, root_dir, save_nii_dir, done, min_slices = 5, file_format = 'nii.gz'):
+    """
+    # Description
+        * Convert every series of one DICOM directory (worker of batch_dcm2nii)
+        * One header pass, then one decode per series
+
+    Return :
+        rows (list): manifest rows (dict) of the converted / failed series
+    """
+    rows = []
+    start = time.time()
+    try:
+        series = split_dcm_series(dicom_dir)
+    except Exception as error:
+        return [dict(source=dicom_dir, series_uid='', description='', output='', shape='', spacing='',
+                     read_time='', write_time='', total_time=round(time.time() - start, 3), error=repr(error))]
+    
+    relative_dir = os.path.relpath(dicom_dir, root_dir)
+    for series_uid, slices in series.items():
+        if len(slices) < min_slices or (dicom_dir, series_uid) in done:
+            continue
+        dicom_files = [dicom_file for dicom_file, _ in slices]
+        dicoms = [dicom for _, dicom in slices]
+        output = os.path.join(save_nii_dir, relative_dir, series_uid.replace('#', '_') + '.' + file_format)
+        row = dict(source=dicom_dir, series_uid=series_uid, description=str(dicoms[0].get('SeriesDescription', '')),
+                   output=output, shape='', spacing='', read_time='', write_time='', total_time='', error='')
+        series_start = time.time()
+        try:
+            volume, flipflag = _read_dcm_volume(dicom_files, dicoms)
+            read_end = time.time()
+            affine = _dcm_affine(dicoms)
+            dcm2nii(dicom_dir, os.path.dirname(output), os.path.basename(output), volume, flipflag, affine=affine)
+            row['shape'] = 'x'.join(str(size) for size in volume.shape)
+            row['spacing'] = 'x'.join(str(float(value)) for value in dicoms[0].PixelSpacing) + \
+                             'x' + str(round(float(np.linalg.norm(affine[:3, 2])), 4))
+            row['read_time'] = round(read_end - series_start, 3)
+            row['write_time'] = round(time.time() - read_end, 3)
+        except Exception as error:
+            row['error'] = repr(error)
+        row['total_time'] = round(time.time() - series_start, 3)
+        rows.append(row)
+    return rows
+
+
+def _read_manifest(manifest_path):
+    """
+    # Description
+        * Successfully converted (source, series_uid) of an existing manifest
+    """
+    done = set()
+    if not os.path.exists(manifest_path):
+        return done
+    with open(manifest_path, newline='') as file:
+        for row in csv.DictReader(file):
+            if row['error'] == '' and os.path.exists(row['output']):
+                done.add((row['source'], row['series_uid']))
+    return done
+
+
+def batch_dcm2nii(root_dir, save_nii_dir, workers = None, manifest_path = None, 
+                  min_slices = 5, file_format = 'nii.gz'):
+    """
+    # Description
+        * Convert every DICOM series found under root_dir to NIFTI
+        * Directories are converted on a process pool, 
+          every series is recorded in a CSV manifest (source, output, shape, spacing, timings, error)
+        * Series already converted in the manifest are skipped, so an interrupted run can be restarted
+
+    Args:
+        root_dir (str): root directory searched for DICOM directories
+        save_nii_dir (str): output root, the directory tree of root_dir is kept
+        workers (int): number of worker processes (None : serial)
+        manifest_path (str): manifest CSV path (None : save_nii_dir/manifest.csv)
+        min_slices (int): skip series with fewer slices (localizers)
+        file_format (str): 'nii.gz' or 'nii'
+
+    Returns:
+        manifest_path (str): manifest CSV path
+
+    example :
+        >>> batch_dcm2nii('D:/PACS_export/', 'D:/nifti/', workers=16)
+        
+        $ python -m utils.convert D:/PACS_export/ D:/nifti/ --workers 16
+    """
+    os.makedirs(save_nii_dir, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = os.path.join(save_nii_dir, 'manifest.csv')
+    done = _read_manifest(manifest_path)
+    
+    dicom_dirs = sorted(root for root, _, files in os.walk(root_dir) if len(files) > 0)
+    
+    new_file = not os.path.exists(manifest_path)
+    with open(manifest_path, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=MANIFEST_FIELDS)
+        if new_file:
+            writer.writeheader()
+        
+        def write_rows(rows):
+            writer.writerows(rows)
+            file.flush()
+        
+        if workers is None or workers <= 1:
+            for dicom_dir in tqdm(dicom_dirs):
+                write_rows(_convert_dcm_dir(dicom_dir, root_dir, save_nii_dir, done, min_slices, file_format))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_convert_dcm_dir, dicom_dir, root_dir, save_nii_dir, 
+                                           {key for key in done if key[0] == dicom_dir}, min_slices, file_format)
+                           for dicom_dir in dicom_dirs]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    write_rows(future.result())
+    return manifest_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch DICOM to NIFTI conversion')
+    parser.add_argument('root_dir', help='root directory searched for DICOM directories')
+    parser.add_argument('save_nii_dir', help='output root directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--manifest', default=None, help='manifest CSV path (default save_nii_dir/manifest.csv)')
+    parser.add_argument('--min-slices', type=int, default=5, help='skip series with fewer slices')
+    parser.add_argument('--format', default='nii.gz', choices=['nii.gz', 'nii'], help='output format')
+    args = parser.parse_args()
+    manifest_path = batch_dcm2nii(args.root_dir, args.save_nii_dir, args.workers, args.manifest, 
+                                  args.min_slices, args.format)
+    print("Manifest : ", manifest_path)
+
+
+if __name__ == '__main__':
+    main()
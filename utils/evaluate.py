@@ -12,7 +12,8 @@ Log
 
 """
 
-import os, glob, shutil
+import os, glob, shutil, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -23,21 +24,86 @@ from pydicom import dcmread
 from tqdm import tqdm
 import ipywidgets as widgets
 from datetime import date
-import skimage
+from scipy import ndimage, sparse
+from scipy.optimize import linear_sum_assignment
 
-def norm(array):
+from .intensity import normalize
+
+
+def norm(array, out = None, dtype = None):
     """
     Normalize array function
     
     Args : 
         array (array) : normalize target array
+        out (array) : output array (array itself for in-place float normalization)
+        dtype (dtype) : output dtype (None : dtype of float array, float64 otherwise)
     Return 
         array (array) : normalized array
     
     """
     
-    array = (array- array.min())/(array.max()- array.min())
-    return array
+    if dtype is None and out is None:
+        dtype = array.dtype if np.issubdtype(array.dtype, np.floating) else np.float64
+    return normalize(array, out=out, dtype=dtype)
+
+def _iter_chunks(label, predict, chunk_size = 1 << 22):
+    """
+    Iterate over flat chunks of two arrays of the same shape 
+    (slabs of the first axis, no full size copy even for non contiguous / memory-mapped arrays)
+    
+    Yields:
+        (label_chunk, predict_chunk) : 1D arrays
+    """
+    label = np.asanyarray(label)
+    predict = np.asanyarray(predict)
+    if label.shape != predict.shape:
+        raise ValueError("label and predict must have the same shape")
+    if label.ndim == 0:
+        yield label.reshape(-1), predict.reshape(-1)
+        return
+    rows = max(1, chunk_size // max(1, label[0].size))
+    for start in range(0, label.shape[0], rows):
+        yield np.asarray(label[start:start + rows]).reshape(-1), np.asarray(predict[start:start + rows]).reshape(-1)
+
+
+def _encode_labels(values, num_classes):
+    """
+    Encode label values as class indices, values outside 0 ~ num_classes-1 
+    (or not integer) are mapped to num_classes (ignored bin)
+    """
+    codes = values.astype(np.int64)
+    invalid = (codes < 0) | (codes >= num_classes)
+    if values.dtype.kind == 'f':
+        invalid |= codes != values
+    codes[invalid] = num_classes
+    return codes
+
+
+def _bincount_confusion(label, predict, num_classes, chunk_size = 1 << 22):
+    """
+    Confusion matrix of integer label maps in one pass over the voxels
+    (label * (K+1) + predict encoding and np.bincount, chunked to bound the temporaries)
+    
+    Args:
+        label (ndarray): Label numpy array
+        predict (ndarray): prediction numpy array
+        num_classes (int): number of classes K
+        chunk_size (int): voxels per chunk
+        
+    Returns:
+        cm (ndarray): (K+1, K+1) int64 matrix, rows label / columns predict, 
+                      last row / column counts values outside 0 ~ K-1
+    """
+    size = num_classes + 1
+    cm = np.zeros(size * size, dtype=np.int64)
+    for label_chunk, predict_chunk in _iter_chunks(label, predict, chunk_size):
+        codes = _encode_labels(label_chunk, num_classes)
+        codes *= size
+        codes += _encode_labels(predict_chunk, num_classes)
+        cm += np.bincount(codes, minlength=size * size)
+    return cm.reshape(size, size)
+
 
 def _calculate_confusion_matrix(label, predict):
     """
@@ -50,16 +116,69 @@ def _calculate_confusion_matrix(label, predict):
     Returns:
         tuple: (tp, fp, fn, tn)
     """
-    predict_eq_0 = predict == 0
-    predict_eq_1 = predict == 1
-    target_eq_0 = label == 0
-    target_eq_1 = label == 1
-    tp = np.sum(np.logical_and(predict_eq_1, target_eq_1))
-    fp = np.sum(np.logical_and(predict_eq_1, target_eq_0))
-    fn = np.sum(np.logical_and(predict_eq_0, target_eq_1))
-    tn = np.sum(np.logical_and(predict_eq_0, target_eq_0))
+    cm = _bincount_confusion(label, predict, 2)
+    tp = cm[1, 1]
+    fp = cm[0, 1]
+    fn = cm[1, 0]
+    tn = cm[0, 0]
     return tp, fp, fn, tn
 
+
+def multiclass_confusion_matrix(label, predict, num_classes = None):
+    """
+    Calculate K x K confusion matrix of multi-label segmentations in one pass
+
+    Args:
+        label (ndarray): Label numpy array (integer class map)
+        predict (ndarray): prediction numpy array (integer class map)
+        num_classes (int): number of classes including background (None : max label + 1)
+        
+    Returns:
+        cm (ndarray): (K, K) int64 matrix, rows label / columns predict
+    """
+    if num_classes is None:
+        num_classes = int(max(np.max(label), np.max(predict))) + 1
+    return _bincount_confusion(label, predict, num_classes)[:num_classes, :num_classes]
+
+
+def class_metrics(label, predict, num_classes = None, cm = None):
+    """
+    Calculate dice, sensitivity, precision, recall, f1_score, fpr of every class
+    from a single confusion matrix (one pass over the voxels)
+
+    Args:
+        label (ndarray): Label numpy array (integer class map)
+        predict (ndarray): prediction numpy array (integer class map)
+        num_classes (int): number of classes including background (None : max label + 1)
+        cm (ndarray): precomputed K x K confusion matrix (label / predict are ignored)
+        
+    Returns:
+        metrics (pandas.DataFrame): one row per class (tp, fp, fn, tn, dice, sensitivity, 
+                                    precision, recall, f1_score, fpr)
+    
+    Example)
+    >>> metrics = class_metrics(label, predict, num_classes=15)
+    >>> metrics.loc[1:, 'dice'].mean()
+    """
+    if cm is None:
+        cm = multiclass_confusion_matrix(label, predict, num_classes)
+    tp = np.diag(cm)
+    fp = cm.sum(axis=0) - tp
+    fn = cm.sum(axis=1) - tp
+    tn = cm.sum() - tp - fp - fn
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dice = 2 * tp / (2 * tp + fp + fn)
+        sensitivity = tp / (tp + fn)
+        precision = tp / (tp + fp)
+        recall = sensitivity
+        f1_score = 2 * (precision * recall) / (precision + recall)
+        fpr = fp / (fp + tn)
+    metrics = pd.DataFrame({'tp' : tp, 'fp' : fp, 'fn' : fn, 'tn' : tn, 
+                            'dice' : dice, 'sensitivity' : sensitivity, 'precision' : precision, 
+                            'recall' : recall, 'f1_score' : f1_score, 'fpr' : fpr})
+    metrics.index.name = 'class'
+    return metrics
+
 def confusion_matrix(label, predict, cm_flag = False):
     """
     Calculate confusion matrix
@@ -86,6 +205,130 @@ def confusion_matrix(label, predict, cm_flag = False):
         fpr = fp / (fp + tn) # False Positive Rate
         return dice, sensitivity, precision, recall, f1_score, fpr
 
+class ConfusionMatrixAccumulator:
+    """
+    Streaming confusion matrix, fed slab by slab (or slice by slice)
+    The final matrix is exactly the one of the whole volume
+    
+    Args:
+        num_classes (int): number of classes including background (2 : binary)
+        
+    Example)
+    >>> accumulator = ConfusionMatrixAccumulator(num_classes=2)
+    >>> for z in range(0, depth, 16):
+    ...     accumulator.update(label_proxy[..., z:z+16], predict_proxy[..., z:z+16])
+    >>> dice, sensitivity, precision, recall, f1_score, fpr = accumulator.confusion_matrix()
+    """
+    
+    def __init__(self, num_classes = 2):
+        self.num_classes = num_classes
+        self.cm = np.zeros((num_classes + 1, num_classes + 1), dtype=np.int64)
+        
+    def update(self, label, predict):
+        self.cm += _bincount_confusion(label, predict, self.num_classes)
+        return self
+    
+    def confusion_matrix(self, cm_flag = False):
+        """
+        Same return as confusion_matrix(label, predict, cm_flag) for class 1 vs class 0
+        """
+        tp, fp, fn, tn = self.cm[1, 1], self.cm[0, 1], self.cm[1, 0], self.cm[0, 0]
+        if cm_flag:
+            return tp, fp, fn, tn
+        dice = 2 * tp / (2 * tp + fp + fn)
+        sensitivity = tp / (tp + fn)
+        precision = tp / (tp + fp)    
+        recall = tp / (tp + fn)
+        f1_score = 2 * (precision * recall) / (precision + recall)
+        fpr = fp / (fp + tn)
+        return dice, sensitivity, precision, recall, f1_score, fpr
+    
+    def multiclass_confusion_matrix(self):
+        return self.cm[:self.num_classes, :self.num_classes].copy()
+    
+    def class_metrics(self):
+        return class_metrics(None, None, cm=self.multiclass_confusion_matrix())
+
+
+class ErrorAccumulator:
+    """
+    Streaming mae, mse, rmse, psnr, fed slab by slab (or slice by slice)
+    Integer inputs are accumulated exactly in int64, float inputs in float64 per chunk
+    
+    Args:
+        data_range (float): data range of psnr
+        
+    Example)
+    >>> accumulator = ErrorAccumulator(data_range=1.0)
+    >>> for label_slab, predict_slab in slabs:
+    ...     accumulator.update(label_slab, predict_slab)
+    >>> accumulator.mae(), accumulator.rmse(), accumulator.psnr()
+    """
+    
+    def __init__(self, data_range = 1.0):
+        self.data_range = data_range
+        self.count = 0
+        self.abs_sum = 0
+        self.square_sum = 0
+        
+    def update(self, label, predict, chunk_size = 1 << 22):
+        for label_chunk, predict_chunk in _iter_chunks(label, predict, chunk_size):
+            if label_chunk.dtype.kind in 'iub' and predict_chunk.dtype.kind in 'iub':
+                difference = label_chunk.astype(np.int64) - predict_chunk.astype(np.int64)
+                self.abs_sum += int(np.abs(difference).sum())
+                self.square_sum += int(np.dot(difference, difference))
+            else:
+                difference = label_chunk.astype(np.float64) - predict_chunk
+                self.abs_sum += float(np.abs(difference).sum())
+                self.square_sum += float(np.dot(difference, difference))
+            self.count += label_chunk.size
+        return self
+    
+    def mae(self):
+        return self.abs_sum / self.count
+    
+    def mse(self):
+        return self.square_sum / self.count
+    
+    def rmse(self):
+        return np.sqrt(self.mse())
+    
+    def psnr(self):
+        mse = self.mse()
+        if mse == 0:
+            return np.inf
+        return 10 * np.log10(self.data_range ** 2 / mse)
+
+
+def evaluate_nii_streaming(label_path, predict_path, num_classes = 2, slab_size = 16, data_range = 1.0):
+    """
+    Out-of-core evaluation of two NIFTI files, read slab by slab along the last axis 
+    (memory-mapped for uncompressed .nii), neither volume is ever fully in memory
+
+    Args:
+        label_path (str): label NIFTI path
+        predict_path (str): prediction NIFTI path
+        num_classes (int): number of classes including background
+        slab_size (int): slices per slab
+        data_range (float): data range of psnr
+        
+    Returns:
+        metrics (pandas.DataFrame): class_metrics of every class
+        errors (dict): mae, mse, rmse, psnr
+    """
+    label_proxy = nib.load(label_path).dataobj
+    predict_proxy = nib.load(predict_path).dataobj
+    confusion = ConfusionMatrixAccumulator(num_classes)
+    error = ErrorAccumulator(data_range)
+    for start in range(0, label_proxy.shape[-1], slab_size):
+        label_slab = np.asarray(label_proxy[..., start:start + slab_size])
+        predict_slab = np.asarray(predict_proxy[..., start:start + slab_size])
+        confusion.update(label_slab, predict_slab)
+        error.update(label_slab, predict_slab)
+    errors = {'mae' : error.mae(), 'mse' : error.mse(), 'rmse' : error.rmse(), 'psnr' : error.psnr()}
+    return confusion.class_metrics(), errors
+
+
 def dice(label, predict):
     """calculate dice
 
@@ -172,30 +415,399 @@ def fpr(label, predict):
     fpr = fp / (fp + tn)
     return fpr
 
-def ssim(label, predict):
-    """calculate ssim
+def _surface_distances(label, predict, spacing = None):
+    """
+    Distances between the surfaces of two binary masks
+    * Euclidean distance transforms restricted to the bounding box of the union of both masks
+    
+    Args:
+        label (ndarray): binary label mask
+        predict (ndarray): binary prediction mask
+        spacing (tuple): voxel spacing of every axis (None : 1 voxel)
+        
+    Returns:
+        label_to_predict (ndarray): distance of every label surface voxel to the prediction surface
+        predict_to_label (ndarray): distance of every prediction surface voxel to the label surface
+        (None, None) if both masks are empty
+    """
+    label = np.asarray(label, dtype=bool)
+    predict = np.asarray(predict, dtype=bool)
+    if spacing is None:
+        spacing = (1.0,) * label.ndim
+    bbox = ndimage.find_objects((label | predict).astype(np.uint8))
+    if len(bbox) == 0:
+        return None, None
+    # crop with a 1 voxel background border, the surface at the crop edge stays a surface
+    label = np.pad(label[bbox[0]], 1)
+    predict = np.pad(predict[bbox[0]], 1)
+    
+    label_surface = label & ~ndimage.binary_erosion(label)
+    predict_surface = predict & ~ndimage.binary_erosion(predict)
+    if not label_surface.any() or not predict_surface.any():
+        return np.full(int(label_surface.sum()), np.inf), np.full(int(predict_surface.sum()), np.inf)
+    
+    label_to_predict = ndimage.distance_transform_edt(~predict_surface, sampling=spacing)[label_surface]
+    predict_to_label = ndimage.distance_transform_edt(~label_surface, sampling=spacing)[predict_surface]
+    return label_to_predict, predict_to_label
+
+
+def _surface_scores(label_to_predict, predict_to_label, tolerance = 1.0):
+    """
+    hd, hd95, assd, nsd from the two directed surface distances
+    """
+    if label_to_predict is None:
+        return {'hd' : 0.0, 'hd95' : 0.0, 'assd' : 0.0, 'nsd' : 1.0}
+    if len(label_to_predict) == 0 or len(predict_to_label) == 0 or np.isinf(label_to_predict).any():
+        return {'hd' : np.inf, 'hd95' : np.inf, 'assd' : np.inf, 'nsd' : 0.0}
+    distances = np.concatenate([label_to_predict, predict_to_label])
+    return {'hd'   : float(max(label_to_predict.max(), predict_to_label.max())),
+            'hd95' : float(max(np.percentile(label_to_predict, 95), np.percentile(predict_to_label, 95))),
+            'assd' : float(distances.mean()),
+            'nsd'  : float(np.mean(distances <= tolerance))}
+
+
+def hausdorff_distance(label, predict, spacing = None):
+    """calculate hausdorff distance
+
+    Args:
+        label (ndarray): binary label mask
+        predict (ndarray): binary prediction mask
+        spacing (tuple): voxel spacing (mm) of every axis, None : voxel units
+        
+    Returns:
+        hd: maximum surface distance
+    """
+    return _surface_scores(*_surface_distances(label, predict, spacing))['hd']
+
+def hd95(label, predict, spacing = None):
+    """calculate 95th percentile hausdorff distance
+
+    Args:
+        label (ndarray): binary label mask
+        predict (ndarray): binary prediction mask
+        spacing (tuple): voxel spacing (mm) of every axis, None : voxel units
+        
+    Returns:
+        hd95: 95th percentile surface distance (max of both directions)
+    """
+    return _surface_scores(*_surface_distances(label, predict, spacing))['hd95']
+
+def assd(label, predict, spacing = None):
+    """calculate average symmetric surface distance
+
+    Args:
+        label (ndarray): binary label mask
+        predict (ndarray): binary prediction mask
+        spacing (tuple): voxel spacing (mm) of every axis, None : voxel units
+        
+    Returns:
+        assd: mean of the surface distances of both directions
+    """
+    return _surface_scores(*_surface_distances(label, predict, spacing))['assd']
+
+def nsd(label, predict, spacing = None, tolerance = 1.0):
+    """calculate normalized surface dice
+
+    Args:
+        label (ndarray): binary label mask
+        predict (ndarray): binary prediction mask
+        spacing (tuple): voxel spacing (mm) of every axis, None : voxel units
+        tolerance (float): accepted surface distance (same unit as spacing)
+        
+    Returns:
+        nsd: fraction of both surfaces within tolerance of the other surface
+    """
+    return _surface_scores(*_surface_distances(label, predict, spacing), tolerance)['nsd']
+
+def _object_codes(array):
+    """
+    Integer class map accepted by ndimage.find_objects without a full-volume copy
+    (integer maps are used as they are, labels <= 0 are ignored; only bool / float maps are converted)
+    """
+    array = np.asarray(array)
+    if array.dtype == bool:
+        return array.view(np.uint8)
+    if np.issubdtype(array.dtype, np.integer):
+        return array
+    codes = array.astype(np.intp)
+    np.maximum(codes, 0, out=codes)
+    return codes
+
+def surface_metrics(label, predict, spacing = None, classes = None, tolerance = 1.0):
+    """calculate hd, hd95, assd, nsd of every class in one call
+
+    Args:
+        label (ndarray): Label numpy array (integer class map)
+        predict (ndarray): prediction numpy array (integer class map)
+        spacing (tuple): voxel spacing (mm) of every axis, None : voxel units
+                         (load_nii arrays : header.get_zooms() with axis 0 and 1 swapped)
+        classes (list): classes to evaluate (None : every foreground class present)
+        tolerance (float): nsd tolerance
+        
+    Returns:
+        metrics (pandas.DataFrame): one row per class (hd, hd95, assd, nsd)
+    """
+    label_codes = _object_codes(label)
+    predict_codes = _object_codes(predict)
+    # bounding boxes of every class of both maps in one pass each
+    label_boxes = ndimage.find_objects(label_codes)
+    predict_boxes = ndimage.find_objects(predict_codes)
+    if classes is None:
+        classes = sorted({index + 1 for index, box in enumerate(label_boxes) if box is not None} |
+                         {index + 1 for index, box in enumerate(predict_boxes) if box is not None})
+    rows = {}
+    for class_num in classes:
+        boxes = [boxes[class_num - 1] for boxes in (label_boxes, predict_boxes) 
+                 if class_num - 1 < len(boxes) and boxes[class_num - 1] is not None]
+        if len(boxes) == 0:
+            rows[class_num] = _surface_scores(None, None, tolerance)
+            continue
+        crop = tuple(slice(min(box[axis].start for box in boxes), max(box[axis].stop for box in boxes))
+                     for axis in range(label_codes.ndim))
+        distances = _surface_distances(label_codes[crop] == class_num, predict_codes[crop] == class_num, spacing)
+        rows[class_num] = _surface_scores(*distances, tolerance)
+    metrics = pd.DataFrame.from_dict(rows, orient='index', columns=['hd', 'hd95', 'assd', 'nsd'])
+    metrics.index.name = 'class'
+    return metrics
+
+def lesion_overlap(label_instances, predict_instances):
+    """
+    Sparse instance overlap (contingency) matrix of two instance label maps in one vectorized pass
+
+    Args:
+        label_instances (ndarray): label instance map (0 background, 1..N)
+        predict_instances (ndarray): prediction instance map (0 background, 1..M)
+        
+    Returns:
+        overlap (scipy.sparse.csr_matrix): (N+1, M+1) voxel counts of every (label, predict) instance pair
+        label_sizes (ndarray): voxel count of every label instance (index = instance id)
+        predict_sizes (ndarray): voxel count of every prediction instance (index = instance id)
+    """
+    label_instances = np.asarray(label_instances).reshape(-1)
+    predict_instances = np.asarray(predict_instances).reshape(-1)
+    # only foreground voxels are visited after the two nonzero scans
+    label_voxels = np.flatnonzero(label_instances)
+    predict_voxels = np.flatnonzero(predict_instances)
+    label_values = label_instances[label_voxels]
+    label_sizes = np.bincount(label_values, minlength=1)
+    predict_sizes = np.bincount(predict_instances[predict_voxels], minlength=1)
+    predict_values = predict_instances[label_voxels]
+    both = predict_values > 0
+    pairs, counts = np.unique(label_values[both].astype(np.int64) * len(predict_sizes) + predict_values[both],
+                              return_counts=True)
+    overlap = sparse.coo_matrix((counts, (pairs // len(predict_sizes), pairs % len(predict_sizes))),
+                                shape=(len(label_sizes), len(predict_sizes))).tocsr()
+    return overlap, label_sizes, predict_sizes
+
+
+def lesion_metrics(label, predict, iou_threshold = 0.1, assignment_flag = False, instance_flag = False, 
+                   connectivity = 3):
+    """calculate lesion-wise (instance level) detection metrics
+
+    * Both masks are labeled once, matching uses the sparse instance overlap matrix
+    
+    Args:
+        label (ndarray): label mask (binary) or instance map (instance_flag)
+        predict (ndarray): prediction mask (binary) or instance map (instance_flag)
+        iou_threshold (float): minimum IoU of a matched (detected) lesion
+        assignment_flag (bool): If True, optimal one-to-one assignment (maximum total IoU),
+                                otherwise greedy matching by decreasing IoU
+        instance_flag (bool): If True, label / predict are already instance maps
+        connectivity (int): connectivity of the instance labeling (3 : 26-connectivity in 3D)
+        
+    Returns:
+        summary (dict): tp, fp, fn, precision, recall, f1_score, lesion_dice 
+                        (mean dice of every label lesion, 0 when missed)
+        lesions (pandas.DataFrame): one row per label lesion (predict_id, voxels, iou, dice, detected)
+        
+    Example)
+    >>> summary, lesions = lesion_metrics(label, predict, iou_threshold=0.1)
+    >>> summary['f1_score'], lesions['dice'].mean()
+    """
+    if instance_flag:
+        label_instances = np.asarray(label).astype(np.int64, copy=False)
+        predict_instances = np.asarray(predict).astype(np.int64, copy=False)
+    else:
+        structure = ndimage.generate_binary_structure(np.ndim(label), connectivity)
+        label_instances, _ = ndimage.label(np.asarray(label) > 0, structure)
+        predict_instances, _ = ndimage.label(np.asarray(predict) > 0, structure)
+    overlap, label_sizes, predict_sizes = lesion_overlap(label_instances, predict_instances)
+    
+    overlap = overlap[1:, 1:].tocoo()
+    label_ids = np.flatnonzero(label_sizes[1:]) + 1
+    predict_ids = np.flatnonzero(predict_sizes[1:]) + 1
+    intersection = overlap.data.astype(np.float64)
+    iou = intersection / (label_sizes[overlap.row + 1] + predict_sizes[overlap.col + 1] - intersection)
+    
+    matches = {}
+    if assignment_flag and len(iou) > 0:
+        # pairs below the threshold cost nothing, so they never take a prediction from a valid match
+        cost = np.zeros(overlap.shape)
+        valid = iou >= iou_threshold
+        cost[overlap.row[valid], overlap.col[valid]] = -iou[valid]
+        rows, cols = linear_sum_assignment(cost)
+        for row, col in zip(rows, cols):
+            if -cost[row, col] >= iou_threshold and cost[row, col] < 0:
+                matches[row + 1] = col + 1
+    else:
+        used = set()
+        for index in np.argsort(-iou, kind='stable'):
+            if iou[index] < iou_threshold:
+                break
+            row, col = overlap.row[index] + 1, overlap.col[index] + 1
+            if row not in matches and col not in used:
+                matches[row] = col
+                used.add(col)
+    
+    pair_iou = {(row + 1, col + 1) : value for row, col, value in zip(overlap.row, overlap.col, iou)}
+    pair_intersection = {(row + 1, col + 1) : value for row, col, value in zip(overlap.row, overlap.col, intersection)}
+    rows = []
+    for label_id in label_ids:
+        predict_id = matches.get(label_id, 0)
+        if predict_id:
+            value = pair_intersection[(label_id, predict_id)]
+            dice = 2 * value / (label_sizes[label_id] + predict_sizes[predict_id])
+            rows.append([label_id, predict_id, label_sizes[label_id], pair_iou[(label_id, predict_id)], dice, True])
+        else:
+            rows.append([label_id, 0, label_sizes[label_id], 0.0, 0.0, False])
+    lesions = pd.DataFrame(rows, columns=['label_id', 'predict_id', 'voxels', 'iou', 'dice', 'detected'])
+    lesions = lesions.set_index('label_id')
+    
+    tp = len(matches)
+    fp = len(predict_ids) - tp
+    fn = len(label_ids) - tp
+    precision = tp / (tp + fp) if tp + fp > 0 else np.nan
+    recall = tp / (tp + fn) if tp + fn > 0 else np.nan
+    f1_score = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else np.nan
+    summary = {'tp' : tp, 'fp' : fp, 'fn' : fn, 'precision' : precision, 'recall' : recall, 
+               'f1_score' : f1_score, 'lesion_dice' : float(lesions['dice'].mean()) if len(lesions) else np.nan}
+    return summary, lesions
+
+def _window_range(window, data_range):
+    """
+    (clip bounds, data_range) of a HU window (center, width)
+    """
+    if window is None:
+        return None, data_range
+    center, width = window
+    return (center - width / 2, center + width / 2), float(width)
+
+
+def _ssim_slab(label, predict, data_range, gaussian_flag, sigma, win_size):
+    """
+    SSIM map of one float32 slab (separable gaussian / uniform filters)
+    """
+    if gaussian_flag:
+        filter_function = lambda array: ndimage.gaussian_filter(array, sigma, truncate=3.5, mode='reflect')
+        cov_norm = 1.0
+    else:
+        filter_function = lambda array: ndimage.uniform_filter(array, win_size, mode='reflect')
+        points = win_size ** label.ndim
+        cov_norm = points / (points - 1)
+    C1 = (0.01 * data_range) ** 2
+    C2 = (0.03 * data_range) ** 2
+    
+    ux = filter_function(label)
+    uy = filter_function(predict)
+    vx = filter_function(label * label)
+    vx -= ux * ux
+    vx *= cov_norm
+    vy = filter_function(predict * predict)
+    vy -= uy * uy
+    vy *= cov_norm
+    vxy = filter_function(label * predict)
+    vxy -= ux * uy
+    vxy *= cov_norm
+    
+    numerator = (2 * ux * uy + C1) * (2 * vxy + C2)
+    denominator = (ux * ux + uy * uy + C1) * (vx + vy + C2)
+    return numerator / denominator
+
+
+def ssim(label, predict, data_range = 1.0, window = None, gaussian_flag = True, sigma = 1.5, 
+         win_size = 7, slab_size = 64, full_flag = False):
+    """calculate 3D ssim
+
+    * Real 3D SSIM (the last axis is not treated as channels), float32, separable filters
+    * Processed in overlapping slabs along the last axis to bound memory
 
     Args:
         label (ndarray): Label numpy array
         predict (ndarray): prediction numpy array
+        data_range (float): data range of the images (ignored if window is given)
+        window (tuple): HU window (center, width), images are clipped to it and data_range = width
+        gaussian_flag (bool): If True, gaussian weights (sigma), otherwise uniform win_size window
+        sigma (float): gaussian sigma
+        win_size (int): uniform window size
+        slab_size (int): slices per slab
+        full_flag (bool): If True, also return the ssim map
         
     Returns:
-        ssim: ssim score
+        ssim: mean ssim (border of half a window excluded, as scikit-image)
+        ssim_map (ndarray): float32 ssim map (only if full_flag is True)
     """
-    ssim = skimage.measure.compare_ssim(label, predict, data_range=1.0, multichannel=True)
+    label = np.asanyarray(label)
+    predict = np.asanyarray(predict)
+    if label.shape != predict.shape:
+        raise ValueError("label and predict must have the same shape")
+    bounds, data_range = _window_range(window, data_range)
+    if gaussian_flag:
+        radius = int(3.5 * sigma + 0.5)
+    else:
+        radius = win_size // 2
+    pad = radius if gaussian_flag else (win_size - 1) // 2
+    if min(label.shape) <= 2 * pad:
+        raise ValueError("every axis must be larger than the ssim window (%d voxels), got shape %s; "
+                         "use a smaller sigma / win_size" % (2 * pad + 1, label.shape))
+    
+    depth = label.shape[-1]
+    ssim_map = np.empty(label.shape, dtype=np.float32) if full_flag else None
+    inner = tuple(slice(pad, size - pad) for size in label.shape[:-1])
+    total = 0.0
+    count = 0
+    for start in range(0, depth, slab_size):
+        stop = min(start + slab_size, depth)
+        low, high = max(0, start - radius), min(depth, stop + radius)
+        label_slab = np.asarray(label[..., low:high], dtype=np.float32)
+        predict_slab = np.asarray(predict[..., low:high], dtype=np.float32)
+        if bounds is not None:
+            label_slab = np.clip(label_slab, bounds[0], bounds[1], out=label_slab)
+            predict_slab = np.clip(predict_slab, bounds[0], bounds[1], out=predict_slab)
+        slab_map = _ssim_slab(label_slab, predict_slab, data_range, gaussian_flag, sigma, win_size)
+        slab_map = slab_map[..., start - low:stop - low]
+        if full_flag:
+            ssim_map[..., start:stop] = slab_map
+        z_low, z_high = max(start, pad), min(stop, depth - pad)
+        if z_high > z_low:
+            core = slab_map[inner + (slice(z_low - start, z_high - start),)]
+            total += float(core.sum(dtype=np.float64))
+            count += core.size
+    
+    ssim = total / count
+    if full_flag:
+        return ssim, ssim_map
     return ssim
 
-def psnr(label, predict):
+def psnr(label, predict, data_range = 1.0, window = None):
     """calculate psnr
 
     Args:
         label (ndarray): Label numpy array
         predict (ndarray): prediction numpy array
+        data_range (float): data range of the images (ignored if window is given)
+        window (tuple): HU window (center, width), images are clipped to it and data_range = width
         
     Returns:
         psnr: psnr score
     """
-    psnr = skimage.measure.compare_psnr(label, predict, data_range=1.0)
+    bounds, data_range = _window_range(window, data_range)
+    accumulator = ErrorAccumulator(data_range)
+    for label_chunk, predict_chunk in _iter_chunks(label, predict):
+        if bounds is not None:
+            label_chunk = np.clip(label_chunk, bounds[0], bounds[1], dtype=np.float32)
+            predict_chunk = np.clip(predict_chunk, bounds[0], bounds[1], dtype=np.float32)
+        accumulator.update(label_chunk, predict_chunk)
+    psnr = accumulator.psnr()
     return psnr
 
 def mae(label, predict):
@@ -208,7 +820,7 @@ def mae(label, predict):
     Returns:
         mae: mae score
     """
-    mae = np.mean(np.abs(label - predict))
+    mae = ErrorAccumulator().update(label, predict).mae()
     return mae
 
 def mse(label, predict):
@@ -221,7 +833,7 @@ def mse(label, predict):
     Returns:
         mse: mse score
     """
-    mse = np.mean((label - predict) ** 2)
+    mse = ErrorAccumulator().update(label, predict).mse()
     return mse
 
 def rmse(label, predict):
@@ -234,6 +846,119 @@ def rmse(label, predict):
     Returns:
         rmse: rmse score
     """
-    rmse = np.sqrt(np.mean((label - predict) ** 2))
+    rmse = ErrorAccumulator().update(label, predict).rmse()
     return rmse
 
+
+
+COHORT_METRICS = ['dice', 'sensitivity', 'precision', 'f1_score', 'fpr']
+SURFACE_METRICS = ['hd', 'hd95', 'assd', 'nsd']
+
+
+def _load_native(path):
+    """
+    Load a NIFTI array with its on-disk dtype (no float64 upcast)
+    """
+    return np.asanyarray(nib.load(path).dataobj)
+
+
+def _evaluate_case(label_path, predict_path, num_classes = None, metrics = COHORT_METRICS):
+    """
+    Evaluate one label / prediction pair (worker of evaluate_cohort)
+    
+    Returns:
+        rows (list): one dict per class (case, class, metrics, load_time, metric_time, error)
+    """
+    case = os.path.basename(label_path)
+    start = time.time()
+    try:
+        label = _load_native(label_path)
+        predict = _load_native(predict_path)
+        load_end = time.time()
+        table = class_metrics(label, predict, num_classes)
+        surface = [metric for metric in metrics if metric in SURFACE_METRICS]
+        if surface:
+            spacing = nib.load(label_path).header.get_zooms()[:label.ndim]
+            table = table.join(surface_metrics(label, predict, spacing, classes=list(table.index[1:]))[surface])
+        metric_end = time.time()
+    except Exception as error:
+        return [{'case' : case, 'label_path' : label_path, 'predict_path' : predict_path, 
+                 'class' : None, 'error' : repr(error)}]
+    rows = []
+    for class_num, values in table[list(metrics)].iterrows():
+        row = {'case' : case, 'label_path' : label_path, 'predict_path' : predict_path, 'class' : int(class_num)}
+        row.update(values.to_dict())
+        row.update({'load_time' : round(load_end - start, 4), 'metric_time' : round(metric_end - load_end, 4), 
+                    'error' : ''})
+        rows.append(row)
+    return rows
+
+
+def _match_pairs(pairs):
+    """
+    (label_glob, predict_glob) -> list of (label_path, predict_path) matched by file name
+    A 2-tuple of plain paths (no glob pattern) is one (label_path, predict_path) pair
+    """
+    if isinstance(pairs, tuple) and len(pairs) == 2 and all(isinstance(pattern, str) for pattern in pairs):
+        if not any(glob.has_magic(pattern) for pattern in pairs):
+            return [pairs]
+        labels = {os.path.basename(path) : path for path in glob.glob(pairs[0])}
+        predicts = {os.path.basename(path) : path for path in glob.glob(pairs[1])}
+        matched = [(labels[name], predicts[name]) for name in sorted(labels) if name in predicts]
+        if len(matched) == 0:
+            raise ValueError("no label / predict files with the same file name for %s (%d labels, %d predicts)" 
+                             % (pairs, len(labels), len(predicts)))
+        return matched
+    return list(pairs)
+
+
+def evaluate_cohort(pairs, num_classes = None, metrics = COHORT_METRICS, workers = None, save_path = None):
+    """
+    Batch evaluation of label / prediction NIFTI pairs on a process pool
+    * Volumes are loaded with their native dtype, each case is evaluated with class_metrics (one pass)
+    * One row per case and class, with per case load / metric timings
+
+    Args:
+        pairs (list or tuple): list of (label_path, predict_path), a single (label_path, predict_path)
+                               or (label_glob, predict_glob) matched by file name (ValueError if nothing matches)
+        num_classes (int): number of classes including background (None : max label + 1 per case)
+        metrics (list): class_metrics columns and / or surface_metrics columns (hd, hd95, assd, nsd,
+                        in mm from the NIFTI header spacing) to report
+        workers (int): number of worker processes (None : serial)
+        save_path (str): .csv (written while the cases complete) or .parquet output (None : not saved)
+        
+    Returns:
+        results (pandas.DataFrame): per case / per class metrics
+        
+    Example)
+    >>> results = evaluate_cohort(('label/*.nii.gz', 'predict/*.nii.gz'), num_classes=15, 
+    ...                           workers=32, save_path='validation.csv')
+    >>> results[results['class'] > 0].groupby('class')['dice'].mean()
+    """
+    pairs = _match_pairs(pairs)
+    rows = []
+    columns = ['case', 'label_path', 'predict_path', 'class'] + list(metrics) + ['load_time', 'metric_time', 'error']
+    csv_flag = save_path is not None and save_path.endswith('.csv')
+    
+    def collect(case_rows):
+        if csv_flag:
+            pd.DataFrame(case_rows).reindex(columns=columns).to_csv(save_path, mode='a', index=False, 
+                                                                     header=len(rows) == 0)
+        rows.extend(case_rows)
+    
+    if csv_flag and os.path.exists(save_path):
+        os.remove(save_path)
+    if workers is None or workers <= 1:
+        for label_path, predict_path in tqdm(pairs):
+            collect(_evaluate_case(label_path, predict_path, num_classes, metrics))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_evaluate_case, label_path, predict_path, num_classes, metrics)
+                       for label_path, predict_path in pairs]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                collect(future.result())
+    
+    results = pd.DataFrame(rows).reindex(columns=columns)
+    if save_path is not None and save_path.endswith('.parquet'):
+        results.to_parquet(save_path, index=False)
+    return results
@@ -0,0 +1,233 @@
+"""
+Log
+
+* Written by HongYongGi / email: hyg4438@gmail.com
+
+* Written date : 20261018
+
+
+# Intensity code
+
+* Normalization and windowing kernels shared by evaluate, plot and recist
+* float32 / in-place / out= support, chunked single pass min-max,
+  lookup table windowing of int16 HU volumes
+
+"""
+
+import numpy as np
+
+
+WINDOWS = {
+    'lung'        : (-600, 1500),
+    'mediastinal' : (40, 400),
+    'bone'        : (400, 1800),
+}
+
+CHUNK_SIZE = 1 << 22
+
+
+def _chunks(array, chunk_size = CHUNK_SIZE):
+    """
+    Slabs of the first axis with about chunk_size elements (views, no copy)
+    """
+    if array.ndim == 0:
+        yield (), array
+        return
+    rows = max(1, chunk_size // max(1, array[0].size))
+    for start in range(0, array.shape[0], rows):
+        index = slice(start, start + rows)
+        yield index, array[index]
+
+
+def _output(array, out, dtype):
+    if out is None:
+        out = np.empty(array.shape, dtype=dtype)
+    elif out.shape != array.shape:
+        raise ValueError("out must have the same shape as array")
+    return out
+
+
+def minmax(array):
+    """
+    Min and max in one pass over the data (both computed per chunk while it is in cache)
+
+    Args:
+        array (array): input array
+    Return
+        (min, max)
+    """
+    array = np.asanyarray(array)
+    low, high = None, None
+    for _, chunk in _chunks(array):
+        chunk_low, chunk_high = chunk.min(), chunk.max()
+        low = chunk_low if low is None else min(low, chunk_low)
+        high = chunk_high if high is None else max(high, chunk_high)
+    return low, high
+
+
+def normalize(array, out = None, dtype = np.float32, low = None, high = None):
+    """
+    Min-max normalization to 0 ~ 1 without full size temporaries
+
+    Args:
+        array (array): input array
+        out (array): output array (may be array itself for in-place float normalization)
+        dtype (dtype): output dtype when out is None
+        low, high (float): normalization bounds (None : min / max of array)
+    Return
+        out (array): normalized array
+    """
+    array = np.asanyarray(array)
+    if low is None or high is None:
+        array_low, array_high = minmax(array)
+        low = array_low if low is None else low
+        high = array_high if high is None else high
+    out = _output(array, out, dtype)
+    scale = 1.0 / (float(high) - float(low)) if high != low else np.inf
+    for index, chunk in _chunks(array):
+        target = out[index]
+        # computed in the output dtype, so integer input cannot overflow before the cast
+        np.subtract(chunk, low, out=target, dtype=target.dtype, casting='unsafe')
+        np.multiply(target, scale, out=target, dtype=target.dtype, casting='unsafe')
+    return out
+
+
+def percentile_normalize(array, lower = 0.5, upper = 99.5, clip_flag = True, out = None, dtype = np.float32):
+    """
+    Percentile normalization, lower / upper percentiles are mapped to 0 / 1
+    Integer volumes (int16 HU, uint8, ...) use an exact histogram instead of sorting a copy
+
+    Args:
+        array (array): input array
+        lower, upper (float): percentiles
+        clip_flag (bool): If True, clip the result to 0 ~ 1
+        out (array): output array
+        dtype (dtype): output dtype when out is None
+    Return
+        out (array): normalized array
+    """
+    array = np.asanyarray(array)
+    if array.dtype.kind in 'iu' and array.dtype.itemsize <= 2:
+        offset = int(np.iinfo(array.dtype).min)
+        histogram = np.zeros(1 << (8 * array.dtype.itemsize), dtype=np.int64)
+        for _, chunk in _chunks(array):
+            histogram += np.bincount((chunk.reshape(-1).astype(np.int32) - offset), minlength=len(histogram))
+        cumulative = np.cumsum(histogram)
+        total = cumulative[-1]
+        # same rank convention as np.percentile(method='lower')
+        low = np.searchsorted(cumulative, lower / 100 * (total - 1), side='right') + offset
+        high = np.searchsorted(cumulative, upper / 100 * (total - 1), side='right') + offset
+    else:
+        low, high = np.percentile(array, [lower, upper])
+    out = normalize(array, out, dtype, low, high)
+    if clip_flag:
+        for index, chunk in _chunks(out):
+            np.clip(chunk, 0, 1, out=chunk)
+    return out
+
+
+def window_bounds(center, width, integer_flag = False):
+    """
+    Window bounds center - width / 2 ~ center + width / 2
+    (integer_flag : rounded inward to integers, for integer arrays)
+    """
+    low, high = center - width / 2, center + width / 2
+    if integer_flag:
+        return int(np.ceil(low)), int(np.floor(high))
+    return low, high
+
+
+def clip_window(array, center, width, out = None):
+    """
+    Clip array to a window (center, width), keeps the dtype of array
+
+    Args:
+        array (array): ct_data
+        center (float): window center
+        width (float): window width
+        out (array): output array (array itself for in-place)
+    Return
+        out (array): clipped array
+    """
+    array = np.asanyarray(array)
+    low, high = window_bounds(center, width, array.dtype.kind in 'iub')
+    return np.clip(array, low, high, out=out)
+
+
+def window_lut(center, width, dtype = np.uint8):
+    """
+    Lookup table of a window for int16 values, indexed by the uint16 view of the int16 array
+
+    Args:
+        center (float): window center
+        width (float): window width
+        dtype (dtype): uint8 (0 ~ 255) or float (0 ~ 1)
+    Return
+        lut (array): (65536,) lookup table
+    """
+    values = np.arange(1 << 16, dtype=np.uint16).view(np.int16).astype(np.float32)
+    low, high = window_bounds(center, width)
+    scaled = np.clip((values - low) / (high - low), 0, 1)
+    if np.dtype(dtype) == np.uint8:
+        return np.round(scaled * 255).astype(np.uint8)
+    return scaled.astype(dtype)
+
+
+def apply_window(array, center, width, dtype = np.uint8, out = None):
+    """
+    Window a HU volume straight to uint8 (0 ~ 255) or float (0 ~ 1)
+    int16 volumes use a lookup table (one gather, no float temporaries)
+
+    Args:
+        array (array): ct_data
+        center (float): window center
+        width (float): window width
+        dtype (dtype): output dtype when out is None
+        out (array): output array
+    Return
+        out (array): windowed array
+    """
+    array = np.asanyarray(array)
+    out = _output(array, out, dtype)
+    if array.dtype == np.int16:
+        lut = window_lut(center, width, out.dtype)
+        for index, chunk in _chunks(array):
+            np.take(lut, chunk.view(np.uint16), out=out[index])
+        return out
+    low, high = window_bounds(center, width)
+    for index, chunk in _chunks(array):
+        scaled = np.clip((chunk.astype(np.float32) - low) / (high - low), 0, 1)
+        if out.dtype == np.uint8:
+            np.rint(scaled * 255, out=scaled)
+        out[index] = scaled
+    return out
+
+
+def multi_window(array, windows = ('lung', 'mediastinal', 'bone'), dtype = np.uint8):
+    """
+    Several windows from one read of the volume
+
+    Args:
+        array (array): ct_data
+        windows (list): window names of WINDOWS or (center, width) tuples
+        dtype (dtype): uint8 (0 ~ 255) or float (0 ~ 1)
+    Return
+        out (array): array.shape + (len(windows),)
+
+    Example)
+    >>> channels = multi_window(ct_int16, ('lung', 'mediastinal', 'bone'))
+    >>> channels.shape
+    (512, 512, 300, 3)
+    """
+    array = np.asanyarray(array)
+    windows = [WINDOWS[window] if isinstance(window, str) else window for window in windows]
+    out = np.empty(array.shape + (len(windows),), dtype=dtype)
+    if array.dtype == np.int16:
+        lut = np.stack([window_lut(center, width, dtype) for center, width in windows], axis=-1)
+        for index, chunk in _chunks(array):
+            out[index] = lut[chunk.view(np.uint16)]
+        return out
+    for index, chunk in _chunks(array):
+        for channel, (center, width) in enumerate(windows):
+            apply_window(chunk, center, width, out=out[index][..., channel])
+    return out
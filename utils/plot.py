@@ -19,6 +19,8 @@ from skimage import measure
 from ipywidgets import interact
 from IPython.display import clear_output
 
+from .intensity import clip_window
+
 
 def forceAspect(ax,aspect=1):
     """
@@ -90,7 +92,7 @@ def plot_3d(array, axis,title = '',
         plt.show() 
 
 ###########################################################################################
-def convert_window(array, window_center, window_width):
+def convert_window(array, window_center, window_width, out = None):
     """
     윈도우 레벨 조절 함수 
 
@@ -98,9 +100,9 @@ def convert_window(array, window_center, window_width):
         array (array): ct_data
         window_center (int): window center number
         window_width (int): window_width number
+        out (array): output array (array itself for in-place)
     """
-    array = np.clip(array, window_center - window_width // 2, window_center + window_width // 2)
-    return array
+    return clip_window(array, window_center, window_width, out=out)
     
 
 
@@ -1,15 +1,19 @@
 import numpy as np
-from ants import from_numpy, resample_image, apply_transforms, registration
 from skimage.measure import label
+from scipy import ndimage
+from scipy.spatial import ConvexHull
+from scipy.spatial.distance import cdist
+from scipy.optimize import linear_sum_assignment
+
+from .intensity import clip_window
+from .registration import affine_transform
 
 
 
 
 def Lung_clip(array, level= -500, window = 2000):
-    max_value = level + window/2
-    min_value = level - window/2
-    # 500~ -1500
-    lung_volume = np.clip(array, min_value, max_value, array)
+    # 500~ -1500 (in-place)
+    lung_volume = clip_window(array, level, window, out=array)
     return lung_volume
 
 def split_into_instances(segmentation_mask):
@@ -23,12 +27,79 @@ def split_into_instances(segmentation_mask):
     return labeled_mask
 
 
-def calculate_volume(ct_mask):
+def _integer_labels(ct_mask):
+    ct_mask = np.asarray(ct_mask)
+    if ct_mask.dtype == bool:
+        return ct_mask.view(np.uint8)
+    if np.issubdtype(ct_mask.dtype, np.integer):
+        return ct_mask
+    return ct_mask.astype(np.int64)
+
+
+def lesion_statistics(ct_mask, spacing = None):
+    """
+    Per lesion statistics of a label volume in one pass (find_objects), 
+    everything after that is computed inside each lesion bounding box
+
+    Args:
+        ct_mask (numpy.ndarray): 3D label volume (x, y, z), 0 is background
+        spacing (tuple): voxel spacing in mm (x, y, z), None : voxel units
+    Returns:
+        statistics (dict): instance number -> dict
+            voxels (int): number of voxels
+            volume (float): voxels * voxel volume (mm³ with spacing)
+            centroid (list): [x, y, z] voxel coordinates
+            bbox (tuple): bounding box slices
+            z_hist (numpy.ndarray): voxels per slice inside the bounding box (starts at bbox[2].start)
+            slice_area (numpy.ndarray): z_hist * pixel area
+            key_slice (int): slice with the largest area (first one on ties)
+
+    Example)
+    >>> dummy_mask  = np.zeros((512,512,59))
+    >>> dummy_mask[100:200, 100:200, 20:40] = 1
+    >>> round(lesion_statistics(dummy_mask, spacing=(0.7, 0.7, 2.5))[1.0]['volume'], 3)
+    245000.0
+    """
+    key_type = np.asarray(ct_mask).dtype.type
+    labels   = _integer_labels(ct_mask)
+    if spacing is None:
+        pixel_area, voxel_volume = 1.0, 1.0
+    else:
+        spacing      = [float(value) for value in spacing]
+        pixel_area   = spacing[0] * spacing[1]
+        voxel_volume = float(np.prod(spacing[:labels.ndim]))
+
+    statistics = {}
+    for index, bbox in enumerate(ndimage.find_objects(labels)):
+        if bbox is None:
+            continue
+        instance = index + 1
+        crop     = labels[bbox] == instance
+        x_hist   = crop.sum(axis=(1, 2))
+        y_hist   = crop.sum(axis=(0, 2))
+        z_hist   = crop.sum(axis=(0, 1))
+        voxels   = int(z_hist.sum())
+        centroid = [float(np.dot(hist, np.arange(len(hist))) / voxels + axis.start)
+                    for hist, axis in zip((x_hist, y_hist, z_hist), bbox)]
+        statistics[key_type(instance)] = {
+            'voxels'     : voxels,
+            'volume'     : voxels * voxel_volume,
+            'centroid'   : centroid,
+            'bbox'       : bbox,
+            'z_hist'     : z_hist,
+            'slice_area' : z_hist * pixel_area,
+            'key_slice'  : int(bbox[2].start + np.argmax(z_hist)),
+        }
+    return statistics
+
+
+def calculate_volume(ct_mask, spacing = None):
     """
     This function is to calculate the volume of tumor.
 
     Args:
         ct_mask (numpy.ndarray): 3D array of tumor mask
+        spacing (tuple): voxel spacing in mm, None : number of voxels
     Returns:
         volume (dict): instance number and volume of tumor
     
@@ -40,17 +111,24 @@ def calculate_volume(ct_mask):
     {1.0: 200000, 2.0: 200000}
     
     """
-    instance, count  = np.unique(ct_mask, return_counts=True)
-    return dict(zip(instance[1:], count[1:]))
+    key_type = np.asarray(ct_mask).dtype.type
+    labels   = _integer_labels(ct_mask)
+    count    = np.bincount(labels.ravel())
+    instance = np.flatnonzero(count[1:]) + 1
+    if spacing is None:
+        return {key_type(i): int(count[i]) for i in instance}
+    voxel_volume = float(np.prod([float(value) for value in spacing[:labels.ndim]]))
+    return {key_type(i): count[i] * voxel_volume for i in instance}
 
 
 
-def find_instance_mask(ct_mask):
+def find_instance_mask(ct_mask, statistics = None):
     """
     This function is to find the instance center of tumor.
     
     Args:
         ct_mask (numpy.ndarray): 3D array of tumor mask
+        statistics (dict): precomputed lesion_statistics(ct_mask)
         
     Returns:
         centers (dict): instance number and center of tumor
@@ -63,14 +141,11 @@ def find_instance_mask(ct_mask):
     {1.0: [149.5, 149.5, 29.5], 2.0: [349.5, 349.5, 29.5]}
     
     """
-    class_nums = np.unique(ct_mask)[1:] # 0을 제외해야 하기 때문에 1부터 시작
+    if statistics is None:
+        statistics = lesion_statistics(ct_mask)
     centers = {}
-    for class_num in class_nums:
-        location  = np.where(ct_mask == class_num)
-        x = np.round(np.mean(location[0]),3)
-        y = np.round(np.mean(location[1]),3)
-        z = np.round(np.mean(location[2]),3)
-        centers[class_num] = [x,y,z]
+    for class_num, lesion in statistics.items():
+        centers[class_num] = [np.round(value, 3) for value in lesion['centroid']]
     
     return centers
 
@@ -89,36 +164,113 @@ def calculate_distance(center1, center2):
     return np.sqrt(np.sum(np.square(np.array(center1) - np.array(center2))))
 
 
-def find_closest_coordinates(target_center, centers_list):
+def _center_array(centers, spacing = None):
+    ids    = list(centers)
+    if not ids:
+        return ids, np.zeros((0, 3))
+    points = np.asarray([centers[i] for i in ids], dtype=float)
+    if spacing is not None:
+        points = points * np.asarray([float(value) for value in spacing[:points.shape[1]]])
+    return ids, points
+
+
+def find_closest_coordinates(target_center, centers_list, spacing = None):
     """
     This code is to find the closest coordinates from target center.
     
     Args: 
         target_center (list): target center
-        centers_list (list): list of centers
+        centers_list (dict): instance number -> center (find_instance_mask)
+        spacing (tuple): voxel spacing in mm, None : distance in voxels
     Returns:
+        index : instance number of the closest center
         closest_coordinates (list): closest coordinates
+        distance (float): distance to the closest center
     
     """
-    distance  = []
-    for center in centers_list:
-        distance.append(calculate_distance(target_center,centers_list[center]))
-    index = distance.index(min(distance)) + 1
+    ids, points = _center_array(centers_list, spacing)
+    _, target   = _center_array({0: target_center}, spacing)
+    distance    = np.sqrt(np.sum(np.square(points - target), axis=1))
+    closest     = int(np.argmin(distance))
+    index       = ids[closest]
     
-    return index , centers_list[index], min(distance)
+    return index , centers_list[index], distance[closest]
+
+
+def match_lesions(fixed_centers, moved_centers, spacing = None, threshold = None):
+    """
+    One-to-one lesion matching on centroid distance (Hungarian assignment with a distance gate)
+
+    Args:
+        fixed_centers (dict): instance number -> center (find_instance_mask)
+        moved_centers (dict): instance number -> center
+        spacing (tuple): voxel spacing in mm, None : distances in voxels
+        threshold (float): pairs at threshold distance or further are not matched (None : no gate)
+    Returns:
+        matches (list): (fixed instance, moved instance, distance), sorted by fixed instance order
+        unmatched_fixed (list): fixed instance numbers without a match
+        unmatched_moved (list): moved instance numbers without a match
+
+    Example)
+    >>> match_lesions({1: [10, 10, 5], 2: [40, 40, 5]}, {4: [41, 40, 5], 9: [11, 10, 5]}, threshold=5)
+    ([(1, 9, 1.0), (2, 4, 1.0)], [], [])
+    """
+    fixed_ids, fixed_points = _center_array(fixed_centers, spacing)
+    moved_ids, moved_points = _center_array(moved_centers, spacing)
+    matches = []
+    if len(fixed_ids) and len(moved_ids):
+        distance = cdist(fixed_points, moved_points)
+        cost     = distance.copy()
+        if threshold is not None:
+            # gated pairs cost more than any set of allowed pairs
+            cost[distance >= threshold] = distance.sum() + 1.0
+        rows, cols = linear_sum_assignment(cost)
+        for row, col in zip(rows, cols):
+            if threshold is None or distance[row, col] < threshold:
+                matches.append((fixed_ids[row], moved_ids[col], float(distance[row, col])))
+    matched_fixed = {match[0] for match in matches}
+    matched_moved = {match[1] for match in matches}
+    unmatched_fixed = [i for i in fixed_ids if i not in matched_fixed]
+    unmatched_moved = [i for i in moved_ids if i not in matched_moved]
+    return matches, unmatched_fixed, unmatched_moved
 
     
 
 
+def relabel(ct_mask, mapping, dtype = np.uint16):
+    """
+    Relabel a label volume with a lookup table (one vectorized gather)
+
+    Args:
+        ct_mask (numpy.ndarray): label volume, 0 is background
+        mapping (dict): old instance number -> new instance number (unlisted labels become 0)
+        dtype (dtype): output dtype
+    Returns:
+        relabeled (numpy.ndarray): relabeled volume
+
+    Example)
+    >>> relabel(np.array([0, 3, 7, 3]), {3: 1, 7: 2})
+    array([0, 1, 2, 1], dtype=uint16)
+    """
+    labels = _integer_labels(ct_mask)
+    size   = int(labels.max()) + 1 if labels.size else 1
+    lut    = np.zeros(size, dtype=dtype)
+    for old, new in mapping.items():
+        if 0 < int(old) < size:
+            lut[int(old)] = int(new)
+    return np.take(lut, labels)
+
+
 def select_target_lesion_fixed(ct_mask, Target_lesion_numbers):
     """
     This function is to select the target lesion.
 
     Args:
-        ct_mask (_type_): _description_
-        Target_lesion_numbers (_type_): _description_
+        ct_mask (numpy.ndarray): instance label volume
+        Target_lesion_numbers (int): number of target lesions (largest volumes)
     Returns:
-        target_lesion_mask (_type_): _description_
+        select_mask (numpy.ndarray): target lesions numbered 1 ~ Target_lesion_numbers by volume (uint16)
+        not_select_mask (numpy.ndarray): remaining lesions numbered from 1 by volume (uint16)
     """
     
     
@@ -126,181 +278,120 @@ def select_target_lesion_fixed(ct_mask, Target_lesion_numbers):
     sorted_volume = sorted(volume_dict.items(), key=lambda x: x[1], reverse=True)
     select_volume = sorted_volume[:Target_lesion_numbers]
     not_select_volume = sorted_volume[Target_lesion_numbers:]
-    not_select_mask= np.zeros((ct_mask.shape))
-    select_mask    = np.zeros((ct_mask.shape))
-    instance = 1
-    for i in select_volume:
-        select_mask[ct_mask == i[0]] = instance
-        instance += 1
-    n_instance  = 1
-    for i in not_select_volume:
-        not_select_mask[ct_mask == i[0]] = n_instance
-        n_instance += 1
+    select_mask     = relabel(ct_mask, {i[0]: instance for instance, i in enumerate(select_volume, 1)})
+    not_select_mask = relabel(ct_mask, {i[0]: instance for instance, i in enumerate(not_select_volume, 1)})
     
         
     return select_mask, not_select_mask
 
 
-def select_target_lesion_moved(moved_ct_mask, fixed_ct_mask, non_target_fixed_ct_mask, Threshold_diameter  = 100):
+def select_target_lesion_moved(moved_ct_mask, fixed_ct_mask, non_target_fixed_ct_mask, Threshold_diameter  = 100, spacing = None):
     """
     This function is to select the target lesion.
+    Target and non-target fixed lesions are matched jointly, one-to-one, to the moved lesions
 
     Args:
         moved_ct_mask (numpy.ndarray): Target CT mask
         fixed_ct_mask (numpy.ndarray): Fixed CT mask selected by select_target_lesion_fixed function
+        non_target_fixed_ct_mask (numpy.ndarray): non-target fixed CT mask
+        Threshold_diameter (float): matching distance gate (mm with spacing, voxels otherwise)
+        spacing (tuple): voxel spacing in mm
         
     Returns:
-        target_lesion_mask (numpy.ndarray): Target lesion mask
+        selected_ct_mask (numpy.ndarray): moved lesions matched to target lesions, fixed numbering (uint16)
+        non_selected_ct_mask (numpy.ndarray): moved lesions matched to non-target lesions, fixed numbering (uint16)
+        new_ct_mask (numpy.ndarray): unmatched moved lesions (new lesions) numbered from 1 (uint16)
     
     """
     moved_centers     = find_instance_mask(moved_ct_mask)
     fixed_centers     = find_instance_mask(fixed_ct_mask)
+    non_fixed_centers = find_instance_mask(non_target_fixed_ct_mask)
     
-    new_ct_mask       = np.zeros((moved_ct_mask.shape))
-    
+    all_fixed_centers = {('target', i): center for i, center in fixed_centers.items()}
+    all_fixed_centers.update({('non_target', i): center for i, center in non_fixed_centers.items()})
+    matches, _, unmatched_moved = match_lesions(all_fixed_centers, moved_centers, spacing, Threshold_diameter)
     
-    selected_ct_mask  = np.zeros((moved_ct_mask.shape))
-    for f_center in fixed_centers:
-        index, m_center, distance  = find_closest_coordinates(fixed_centers[f_center], moved_centers)
-        
-        if distance < Threshold_diameter:
-            selected_ct_mask[moved_ct_mask  == index] = f_center
-        elif distance >= Threshold_diameter:
-            new_ct_mask[moved_ct_mask  == index] = f_center
-        
-        
-    non_fixed_centers  = find_instance_mask(non_target_fixed_ct_mask)
-    non_selected_ct_mask = np.zeros((moved_ct_mask.shape))   
-    for nf_center in non_fixed_centers:
-        index, m_center, distance  = find_closest_coordinates(non_fixed_centers[nf_center], moved_centers)
-        if distance < Threshold_diameter:
-            non_selected_ct_mask[moved_ct_mask  == index] = nf_center
-        elif distance >= Threshold_diameter:
-            new_ct_mask[moved_ct_mask  == index] = nf_center        
+    selected     = {m_center: f_center for (kind, f_center), m_center, _ in matches if kind == 'target'}
+    non_selected = {m_center: f_center for (kind, f_center), m_center, _ in matches if kind == 'non_target'}
+    new          = {m_center: instance for instance, m_center in enumerate(unmatched_moved, 1)}
     
-        
+    selected_ct_mask     = relabel(moved_ct_mask, selected)
+    non_selected_ct_mask = relabel(moved_ct_mask, non_selected)
+    new_ct_mask          = relabel(moved_ct_mask, new)
         
     return selected_ct_mask, non_selected_ct_mask, new_ct_mask
         
         
-def affine_transform(affine_reg, fix, move,defaultvalue_num= -1024, inverse_flag = False):
-    """ Affine registration of expiratory image and lung masks to
-        inspiratory image
-        
-        
-    interpolator : string
-        Choice of interpolator. Supports partial matching.
-            linear
-            nearestNeighbor
-            multiLabel for label images (deprecated, prefer genericLabel)
-            gaussian
-            bSpline
-            cosineWindowedSinc
-            welchWindowedSinc
-            hammingWindowedSinc
-            lanczosWindowedSinc
-            genericLabel use this for label images        
-        
+def _largest_component_centers(warped_mask):
     """
-    # affine register image
-    if inverse_flag==False:
-            
-        exp_affine = apply_transforms(fixed=from_numpy(fix),
-                                    moving=from_numpy(move),
-                                    transformlist=affine_reg['fwdtransforms'],
-                                    
-                                    defaultvalue = defaultvalue_num
-                                    )[:, :, :]
-    else:
-        exp_affine = apply_transforms(fixed=from_numpy(fix),
-                                    moving=from_numpy(move),
-                                    transformlist=affine_reg['invtransforms'],
-                                    
-                                    defaultvalue = defaultvalue_num
-                                    )[:, :, :]
-        
+    Center of the largest connected component of every warped lesion (inside its bounding box)
+    """
+    structure = np.ones((3,) * warped_mask.ndim, dtype=bool)
+    centers   = {}
+    for instance, lesion in lesion_statistics(warped_mask).items():
+        bbox = lesion['bbox']
+        components, num_components = ndimage.label(warped_mask[bbox] == instance, structure)
+        if num_components > 1:
+            sizes      = np.bincount(components.ravel())
+            components = components == np.argmax(sizes[1:]) + 1
+        location = np.nonzero(components)
+        centers[instance] = [np.round(np.mean(axis) + origin.start, 3) for axis, origin in zip(location, bbox)]
+    return centers
+
 
-    return exp_affine
-        
-        
-        
-        
-        
-        
 def select_target_lesion_moving(moving_ct_mask, 
                                 moved_ct_mask,
                                 non_moved_ct_mask ,
                                 new_moved_ct_mask,
-                                md_m_affine_matrix):
+                                md_m_affine_matrix,
+                                spacing = None):
     """
     This function is to select the target lesion in the moving CT mask.
+    Target, non-target and new lesions are combined into one label map and warped once
+    (genericLabel interpolation), per lesion work is done inside bounding box crops
 
     Args:
         moving_ct_mask (numpy array): The moving CT mask.
         moved_ct_mask (numpy array): Moved CT mask selected by select_target_lesion_moved function
+        non_moved_ct_mask (numpy array): non-target lesions of select_target_lesion_moved
+        new_moved_ct_mask (numpy array): new lesions of select_target_lesion_moved
+        md_m_affine_matrix (dict): ants registration result (moved -> moving)
+        spacing (tuple): voxel spacing in mm used for matching distances
         
     retunrs: 
-        target_lesion_mask(numpy array): Target lesion mask
+        select_lesion_ct_mask, non_select_lesion_ct_mask, new_lesion_ct_mask (numpy array): uint16 label maps
     
     """
     
-    # Target lesion
-    affine_tumor_m  = np.zeros((moving_ct_mask.shape))
-    class_nums = np.unique(moved_ct_mask)[1:] # 0을 제외해야 하기 때문에 1부터 시작
-
-    for instance_id in class_nums : 
-        tumor_moved  = moved_ct_mask.copy()
-        tumor_moved[tumor_moved==instance_id]= instance_id
-        tumor_moved[tumor_moved!=instance_id]= 0
-        tumor_moved = tumor_moved.astype(np.uint8)
-        temp_m = affine_transform(md_m_affine_matrix, tumor_moved, tumor_moved,0)
-        temp_m = split_into_instances(temp_m)
-        affine_tumor_m[temp_m == 1] = instance_id
-        
-    moving_centers         = find_instance_mask(moving_ct_mask)
-    affine_moving_centers  = find_instance_mask(affine_tumor_m)
-    select_lesion_ct_mask  = np.zeros((moving_ct_mask.shape))     
+    # combined label map : target, non-target and new lesions get disjoint id ranges
+    groups   = [moved_ct_mask, non_moved_ct_mask, new_moved_ct_mask]
+    combined = np.zeros(np.shape(moved_ct_mask), dtype=np.uint32)
+    origin   = {}
+    offset   = 0
+    for group, mask in enumerate(groups):
+        labels = _integer_labels(mask)
+        ids    = np.flatnonzero(np.bincount(labels.ravel())[1:]) + 1
+        if len(ids) == 0:
+            continue
+        lut = np.zeros(int(ids[-1]) + 1, dtype=np.uint32)
+        lut[ids] = np.arange(offset + 1, offset + len(ids) + 1)
+        combined = np.where(labels > 0, np.take(lut, labels), combined)
+        for combined_id, instance_id in zip(lut[ids], ids):
+            origin[int(combined_id)] = (group, np.asarray(mask).dtype.type(instance_id))
+        offset += len(ids)
     
-    for f_center in affine_moving_centers:
-        index, m_center, distance  = find_closest_coordinates(affine_moving_centers[f_center], moving_centers)
-        select_lesion_ct_mask[moving_ct_mask  == index] = f_center
-        
-        
-
-    # Non-target lesion
-    affine_tumor_m1 = np.zeros((moving_ct_mask.shape))
-    class_nums = np.unique(non_moved_ct_mask)[1:] # 0을 제외해야 하기 때문에 1부터 시작
-    for instance_id1 in class_nums : 
-        tumor_moved1  = non_moved_ct_mask.copy()
-        tumor_moved1[tumor_moved1==instance_id1]= instance_id1
-        tumor_moved1[tumor_moved1!=instance_id1]= 0
-        tumor_moved1 = tumor_moved1.astype(np.uint8)
-        temp_m1 = affine_transform(md_m_affine_matrix, tumor_moved1, tumor_moved1,0)
-        temp_m1 = split_into_instances(temp_m1)
-        affine_tumor_m1[temp_m1 == 1] = instance_id1
+    warped = affine_transform(md_m_affine_matrix, combined.astype(np.float32), combined.astype(np.float32), 0,
+                              interpolator='genericLabel')
+    warped = np.rint(warped).astype(np.uint32)
     
-    affine_moving_centers1    = find_instance_mask(affine_tumor_m1)
-    non_select_lesion_ct_mask = np.zeros((moving_ct_mask.shape))
-    for f_center1 in affine_moving_centers1:
-        index1, m_center1, distance1  = find_closest_coordinates(affine_moving_centers1[f_center1], moving_centers)
-        non_select_lesion_ct_mask[moving_ct_mask  == index1] = f_center1
+    warped_centers = {origin[i]: center for i, center in _largest_component_centers(warped).items() if i in origin}
+    moving_centers = find_instance_mask(moving_ct_mask)
+    matches, _, _  = match_lesions(warped_centers, moving_centers, spacing)
     
-    # New Lesion
-    affine_tumor_m2 = np.zeros((moving_ct_mask.shape))
-    class_nums = np.unique(new_moved_ct_mask)[1:] # 0을 제외해야 하기 때문에 1부터 시작
-    for instance_id2 in class_nums:
-        tumor_moved2  = new_moved_ct_mask.copy()
-        tumor_moved2[tumor_moved2==instance_id2]= instance_id2
-        tumor_moved2[tumor_moved2!=instance_id2]= 0
-        tumor_moved2 = tumor_moved2.astype(np.uint8)
-        temp_m2 = affine_transform(md_m_affine_matrix, tumor_moved2, tumor_moved2,0)
-        temp_m2 = split_into_instances(temp_m2)
-        affine_tumor_m2[temp_m2 == 1] = instance_id2
-    affine_moving_centers2    = find_instance_mask(affine_tumor_m2)
-    new_lesion_ct_mask = np.zeros((moving_ct_mask.shape))
-    for f_center2 in affine_moving_centers2:
-        index2, m_center2, distance2  = find_closest_coordinates(affine_moving_centers2[f_center2], moving_centers)
-        new_lesion_ct_mask[moving_ct_mask  == index2] = f_center2    
+    mappings = [{}, {}, {}]
+    for (group, instance_id), moving_id, _ in matches:
+        mappings[group][moving_id] = instance_id
+    select_lesion_ct_mask, non_select_lesion_ct_mask, new_lesion_ct_mask = [relabel(moving_ct_mask, mapping) for mapping in mappings]
         
         
         
@@ -309,36 +400,159 @@ def select_target_lesion_moving(moving_ct_mask,
 ################
 # RECIST utils #
 ################
-def calculate_diameter(binary_mask, key_slice):
-    location  =  np.where(binary_mask == 1)
-    
-    
-    x,y,z = location[0], location[1], key_slice
-    
-    longest_diameter  = 0
-    for idx in range(len(x)):
-        for idx2 in  range(len(x)):
-            diameter  = np.sqrt((x[idx] - x[idx2])**2 + (y[idx] - y[idx2])**2)
-            if diameter > longest_diameter:
-                longest_diameter = diameter
+def _hull_points(binary_slice):
+    """
+    Candidate hull points of a 2D mask : first and last foreground column of every row
+    """
+    rows  = np.flatnonzero(binary_slice.any(axis=1))
+    if len(rows) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    cropped = binary_slice[rows]
+    first   = np.argmax(cropped, axis=1)
+    last    = cropped.shape[1] - 1 - np.argmax(cropped[:, ::-1], axis=1)
+    points  = np.concatenate([np.stack([rows, first], axis=1), np.stack([rows, last], axis=1)])
+    return np.unique(points, axis=0)
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _rotating_calipers(hull):
+    """
+    Farthest pair of a convex polygon (counter-clockwise vertices) by rotating calipers
+    """
+    n = len(hull)
+    tolerance = 1e-9 * max(1.0, float(np.max(np.abs(hull)))) ** 2
+    best, pair = -1.0, (0, 0)
+    j = 1
+    for i in range(n):
+        edge = hull[(i + 1) % n] - hull[i]
+        # advance j while the triangle (i, i+1, j+1) is larger than (i, i+1, j)
+        while True:
+            current = abs(_cross(edge, hull[j] - hull[i]))
+            following = abs(_cross(edge, hull[(j + 1) % n] - hull[i]))
+            if following > current + tolerance:
+                j = (j + 1) % n
+            else:
+                break
+        # edge (j, j+1) parallel to edge (i, i+1) : both j and j+1 are antipodal
+        antipodal = (j, (j + 1) % n) if following > current - tolerance else (j,)
+        for k in (i, (i + 1) % n):
+            for m in antipodal:
+                distance = np.sum(np.square(hull[k] - hull[m]))
+                if distance > best:
+                    best, pair = distance, (k, m)
+    return np.sqrt(best), pair
+
+
+def _perpendicular_chord(hull, start, end):
+    """
+    Longest chord of a convex polygon perpendicular to the segment start-end
+    The chord length is concave along the segment, so the maximum is at a vertex projection
+    """
+    axis   = (end - start) / np.linalg.norm(end - start)
+    normal = np.array([-axis[1], axis[0]])
+    t      = hull @ axis
+    u      = hull @ normal
+    t0, t1 = t, np.roll(t, -1)
+    u0, u1 = u, np.roll(u, -1)
+    best, pair = 0.0, (start, start)
+    for position in t:
+        crossing = (np.minimum(t0, t1) <= position) & (position <= np.maximum(t0, t1))
+        parallel = crossing & (t0 == t1)
+        ratio    = np.divide(position - t0, t1 - t0, out=np.zeros_like(t0), where=t0 != t1)
+        values   = np.concatenate([(u0 + ratio * (u1 - u0))[crossing & ~parallel], u0[parallel], u1[parallel]])
+        if len(values) == 0:
+            continue
+        length = values.max() - values.min()
+        if length > best:
+            best = length
+            pair = (position * axis + values.min() * normal, position * axis + values.max() * normal)
+    return best, pair
+
+
+def calculate_diameter(binary_mask, key_slice, spacing = None, information_flag = False):
+    """
+    RECIST longest axial diameter of a lesion on its key slice
+    (rotating calipers on the convex hull of the key slice, distance between voxel centers)
+
+    Args:
+        binary_mask (numpy.ndarray): 3D lesion mask (x, y, z) or 2D key slice
+        key_slice (int): axial slice index (ignored for 2D masks)
+        spacing (tuple): pixel spacing of the first two axes in mm (PixelSpacing), None : voxel units
+        information_flag (bool): If True, also return short axis and end points
+    Returns:
+        longest_diameter (float): longest diameter
+        information (dict): (information_flag) short_diameter,
+                            long_points / short_points as (x, y, key_slice) voxel coordinates
+
+    Example)
+    >>> dummy_mask = np.zeros((512, 512, 59))
+    >>> dummy_mask[100:131, 100:111, 20:40] = 1
+    >>> calculate_diameter(dummy_mask, 30, spacing=(0.7, 0.7))
+    22.135943621178654
+    """
+    binary_slice = binary_mask[:, :, key_slice] if binary_mask.ndim == 3 else binary_mask
+    scale   = np.ones(2) if spacing is None else np.asarray([float(value) for value in spacing[:2]])
+    points  = _hull_points(binary_slice != 0)
+
+    longest_diameter, short_diameter = 0.0, 0.0
+    long_points, short_points = [], []
+    if len(points) == 1:
+        long_points = short_points = [points[0], points[0]]
+    elif len(points) > 1:
+        offset    = points - points[0]
+        collinear = not np.any(_cross(offset, offset[1]))
+        scaled    = points * scale
+        if collinear:
+            # degenerate hull (single row / column / line) : extremes along the line
+            projection = scaled @ (scaled[1] - scaled[0])
+            first, last = np.argmin(projection), np.argmax(projection)
+            longest_diameter = float(np.linalg.norm(scaled[last] - scaled[first]))
+            long_points  = [points[first], points[last]]
+            short_points = [points[first], points[first]]
+        else:
+            vertices = ConvexHull(scaled).vertices   # counter-clockwise in 2D
+            hull     = scaled[vertices]
+            longest_diameter, (i, j) = _rotating_calipers(hull)
+            longest_diameter = float(longest_diameter)
+            long_points = [points[vertices[i]], points[vertices[j]]]
+            short_diameter, (start, end) = _perpendicular_chord(hull, hull[i], hull[j])
+            short_diameter = float(short_diameter)
+            short_points = [start / scale, end / scale]
+
+    if information_flag:
+        information = {
+            'short_diameter' : short_diameter,
+            'long_points'    : [tuple(point) + (key_slice,) for point in np.asarray(long_points, dtype=float).tolist()],
+            'short_points'   : [tuple(point) + (key_slice,) for point in np.asarray(short_points, dtype=float).tolist()],
+        }
+        return longest_diameter, information
     return longest_diameter
     
 
 
-def get_information(CT_mask): 
-    num_class = np.unique(CT_mask)[1:]
+def get_information(CT_mask, spacing = None): 
+    """
+    Key slice and longest diameter of every lesion
+
+    Args:
+        CT_mask (numpy.ndarray): 3D label volume (x, y, z)
+        spacing (tuple): voxel spacing in mm, None : voxel units
+    Returns:
+        information (dict): instance number -> [key_slice, LD]
+        sum of LD (float)
+    """
     information = {}
     total_LD  = []
-    for idx in num_class:
-        mask = np.zeros((CT_mask.shape))
-        mask[CT_mask == idx] = 1
-        z_hist  = np.sum(mask, axis = (0,1))
-        # print(z_hist)
-        key_slice  = np.where(z_hist==max(z_hist))[0][0]
-        LD         = calculate_diameter(mask, key_slice)
+    for idx, lesion in lesion_statistics(CT_mask, spacing).items():
+        bbox       = lesion['bbox']
+        key_slice  = lesion['key_slice']
+        # 2D crop of the key slice inside the lesion bounding box
+        key_crop   = np.asarray(CT_mask[bbox[0], bbox[1], key_slice]) == idx
+        LD         = calculate_diameter(key_crop, key_slice, spacing)
         LD         = np.round(LD, 3)
         total_LD.append(LD)
         information[idx] = [key_slice, LD]
-    return information , np.sum(total_LD)   
-
-
+    return information , np.sum(total_LD)
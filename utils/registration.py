@@ -1,9 +1,22 @@
-import os, glob, shutil
+import os, glob, shutil, csv, time, hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import nibabel as nib
 from tqdm import tqdm
 from ants import from_numpy, resample_image, apply_transforms, registration
 
+from .cache import array_fingerprint, load_transform_cache, save_transform_cache
+from .convert import load_nii, load_dcm
+
+def _to_ants(arr):
+    """
+    numpy array to ANTsImage as float32 
+    (from_numpy maps int16 to unsigned int, so -1000 HU of load_dcm would wrap around)
+    """
+    return from_numpy(np.asarray(arr, dtype=np.float32))
+
+
 def preprocess(arr, shape, interp = 4):
     """
     Resample CT data to target shape
@@ -15,23 +28,107 @@ def preprocess(arr, shape, interp = 4):
         shape (int): voxelmorph input shape 
         resample_method (int, optional):  Select Interpolation method
     """
-    arr = from_numpy(arr)
+    arr = _to_ants(arr)
     arr = resample_image(arr, shape,1, interp_type=interp)[:, :, :]
     return arr
 
 
 
-def affine_registration(fixed, moving, a = 'AffineFast'):     # fixed (insp) moving (exp) for lung mask
-    """ Affine registration of a moving image to a fixed image"""
+def _warp_outputs(fixed, moving, transforms):
+    """
+    Full resolution warpedmovout / warpedfixout of a set of transforms
+    """
+    fixed_image, moving_image = _to_ants(fixed), _to_ants(moving)
+    transforms['warpedmovout'] = apply_transforms(fixed=fixed_image, moving=moving_image,
+                                                  transformlist=transforms['fwdtransforms'])
+    transforms['warpedfixout'] = apply_transforms(fixed=moving_image, moving=fixed_image,
+                                                  transformlist=transforms['invtransforms'],
+                                                  whichtoinvert=[path.endswith('.mat') for path in transforms['invtransforms']])
+    return transforms
+
+
+def roi_bbox(arr, threshold = None, margin = 8):
+    """
+    Bounding box of the foreground of an image
+
+    Args:
+        arr (array): ct array
+        threshold (float): foreground is arr > threshold (None : arr > arr.min(), e.g. -500 for lung / body)
+        margin (int): margin in voxels
+    Returns:
+        bbox (tuple): slices, the whole image when there is no foreground
+    """
+    foreground = arr > (arr.min() if threshold is None else threshold)
+    bbox = []
+    for axis in range(arr.ndim):
+        index = np.flatnonzero(foreground.any(axis=tuple(i for i in range(arr.ndim) if i != axis)))
+        if len(index) == 0:
+            return tuple(slice(0, size) for size in arr.shape)
+        bbox.append(slice(max(0, index[0] - margin), min(arr.shape[axis], index[-1] + margin + 1)))
+    return tuple(bbox)
+
 
-    affine_reg = registration(fixed=from_numpy(fixed),
-                              moving=from_numpy(moving),
-                              type_of_transform=a)
+def _roi_image(arr, threshold, margin, shrink_factor):
+    """
+    ROI crop placed at its full resolution position (origin = bbox start, spacing 1)
+    and resampled to spacing shrink_factor, so physical coordinates match from_numpy(arr)
+    """
+    bbox  = roi_bbox(arr, threshold, margin)
+    image = from_numpy(np.ascontiguousarray(arr[bbox], dtype=np.float32),
+                       origin=tuple(float(axis.start) for axis in bbox),
+                       spacing=(1.0,) * arr.ndim)
+    if shrink_factor > 1:
+        image = resample_image(image, (float(shrink_factor),) * arr.ndim, use_voxels=False, interp_type=0)
+    return image
+
+
+def affine_registration(fixed, moving, a = 'AffineFast', cache_dir = None, 
+                        roi_flag = False, roi_threshold = None, shrink_factor = 2, margin = 8):     # fixed (insp) moving (exp) for lung mask
+    """ Affine registration of a moving image to a fixed image
+
+    Args:
+        fixed (array): fixed image
+        moving (array): moving image
+        a (str): ants type_of_transform
+        cache_dir (str): transform cache directory (None : no cache), 
+                         keyed on the content of fixed / moving, a and the roi parameters
+        roi_flag (bool): If True, estimate the transform on foreground crops
+                         downsampled by shrink_factor (same physical frame as the full images)
+        roi_threshold (float): foreground threshold of roi_bbox (e.g. -500 HU)
+        shrink_factor (int): downsampling factor of the roi mode
+        margin (int): roi margin in voxels
+    Returns:
+        affine_reg (dict): warpedmovout, warpedfixout (full resolution), fwdtransforms, invtransforms
+                           (transform paths are stable copies in cache_dir when caching)
+    """
+
+    params = (a,) if not roi_flag else (a, 'roi', roi_threshold, shrink_factor, margin)
+    if cache_dir is not None:
+        key        = array_fingerprint([fixed, moving], *params)
+        transforms = load_transform_cache(key, cache_dir)
+        if transforms is not None:
+            # cache hit : only the warped outputs are recomputed
+            return _warp_outputs(fixed, moving, transforms)
+
+    if roi_flag:
+        roi_reg    = registration(fixed=_roi_image(fixed, roi_threshold, margin, shrink_factor),
+                                  moving=_roi_image(moving, roi_threshold, margin, shrink_factor),
+                                  type_of_transform=a)
+        affine_reg = _warp_outputs(fixed, moving, {'fwdtransforms': roi_reg['fwdtransforms'],
+                                                   'invtransforms': roi_reg['invtransforms']})
+    else:
+        affine_reg = registration(fixed=_to_ants(fixed),
+                                  moving=_to_ants(moving),
+                                  type_of_transform=a)
+    if cache_dir is not None:
+        transforms = save_transform_cache(key, affine_reg, cache_dir)
+        if transforms is not None:
+            affine_reg.update(transforms)
     return affine_reg
 
 
 
-def affine_transform(affine_reg, fix, move,defaultvalue_num= -1024, inverse_flag = False):
+def affine_transform(affine_reg, fix, move,defaultvalue_num= -1024, inverse_flag = False, interpolator = 'linear'):
     """ Affine registration of expiratory image and lung masks to
         inspiratory image
         
@@ -53,19 +150,181 @@ def affine_transform(affine_reg, fix, move,defaultvalue_num= -1024, inverse_flag
     # affine register image
     if inverse_flag==False:
             
-        exp_affine = apply_transforms(fixed=from_numpy(fix),
-                                    moving=from_numpy(move),
+        exp_affine = apply_transforms(fixed=_to_ants(fix),
+                                    moving=_to_ants(move),
                                     transformlist=affine_reg['fwdtransforms'],
-                                    
+                                    interpolator=interpolator,
                                     defaultvalue = defaultvalue_num
-                                    )[:, :, :]
+                                    ).numpy()
     else:
-        exp_affine = apply_transforms(fixed=from_numpy(fix),
-                                    moving=from_numpy(move),
+        exp_affine = apply_transforms(fixed=_to_ants(fix),
+                                    moving=_to_ants(move),
                                     transformlist=affine_reg['invtransforms'],
-                                    
+                                    interpolator=interpolator,
                                     defaultvalue = defaultvalue_num
-                                    )[:, :, :]
+                                    ).numpy()
         
 
     return exp_affine
+
+
+
+REGISTRATION_LOG_FIELDS = ['fixed', 'moving', 'output', 'type_of_transform', 'load_time', 'registration_time',
+                           'total_time', 'ncc_before', 'ncc_after', 'fwdtransforms', 'invtransforms', 'error']
+
+
+def _init_registration_worker(threads):
+    """
+    Process pool initializer : ITK thread budget of one worker
+    """
+    if threads is not None:
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+
+
+def _load_image(path):
+    """
+    NIFTI file or DICOM directory to array
+    """
+    if os.path.isdir(path):
+        image = load_dcm(path)[0]
+        if np.isscalar(image):
+            raise ValueError("failed to read DICOM directory %s" % path)
+        return image
+    return load_nii(path)[0]
+
+
+def _ncc(a, b, chunk_size = 1 << 22):
+    """
+    Normalized cross correlation of two arrays (chunked, float64 accumulators)
+    """
+    a, b = np.ravel(a), np.ravel(b)
+    mean_a, mean_b = a.mean(dtype=np.float64), b.mean(dtype=np.float64)
+    cross, var_a, var_b = 0.0, 0.0, 0.0
+    for start in range(0, a.size, chunk_size):
+        chunk_a = a[start:start + chunk_size] - mean_a
+        chunk_b = b[start:start + chunk_size] - mean_b
+        cross += np.dot(chunk_a, chunk_b)
+        var_a += np.dot(chunk_a, chunk_a)
+        var_b += np.dot(chunk_b, chunk_b)
+    return cross / np.sqrt(var_a * var_b) if var_a > 0 and var_b > 0 else 0.0
+
+
+def _pair_dir(save_dir, fixed_path, moving_path):
+    digest = hashlib.blake2b((os.path.abspath(fixed_path) + '\0' + os.path.abspath(moving_path)).encode('utf-8'),
+                             digest_size=8).hexdigest()
+    return os.path.join(save_dir, digest)
+
+
+def _register_pair(fixed_path, moving_path, save_dir, a, registration_kwargs):
+    """
+    Register one (fixed, moving) pair and copy its transforms into save_dir (worker of batch_registration)
+
+    Return :
+        row (dict): registration log row
+    """
+    output = _pair_dir(save_dir, fixed_path, moving_path)
+    row = dict(fixed=fixed_path, moving=moving_path, output=output, type_of_transform=a, load_time='',
+               registration_time='', total_time='', ncc_before='', ncc_after='', fwdtransforms='', invtransforms='', error='')
+    start = time.time()
+    try:
+        fixed, moving = _load_image(fixed_path), _load_image(moving_path)
+        load_end = time.time()
+        affine_reg = affine_registration(fixed, moving, a, **registration_kwargs)
+        registration_end = time.time()
+        
+        os.makedirs(output, exist_ok=True)
+        names = {}
+        for path in affine_reg['fwdtransforms'] + affine_reg['invtransforms']:
+            if path not in names:
+                names[path] = os.path.join(output, '%d_%s' % (len(names), os.path.basename(path)))
+                shutil.copyfile(path, names[path])
+        row['fwdtransforms'] = ';'.join(names[path] for path in affine_reg['fwdtransforms'])
+        row['invtransforms'] = ';'.join(names[path] for path in affine_reg['invtransforms'])
+        if fixed.shape == moving.shape:
+            row['ncc_before'] = round(float(_ncc(fixed, moving)), 5)
+        # NCC after registration over the warped field of view only (outside is filled with 0)
+        overlap = apply_transforms(fixed=_to_ants(fixed), moving=from_numpy(np.ones(moving.shape, dtype=np.float32)),
+                                   transformlist=affine_reg['fwdtransforms'], interpolator='nearestNeighbor').numpy() > 0.5
+        row['ncc_after'] = round(float(_ncc(fixed[overlap], affine_reg['warpedmovout'].numpy()[overlap])), 5)
+        row['load_time'] = round(load_end - start, 3)
+        row['registration_time'] = round(registration_end - load_end, 3)
+    except Exception as error:
+        row['error'] = repr(error)
+    row['total_time'] = round(time.time() - start, 3)
+    return row
+
+
+def _read_registration_log(log_path):
+    """
+    Successfully registered (fixed, moving) pairs of an existing log
+    """
+    done = set()
+    if not os.path.exists(log_path):
+        return done
+    with open(log_path, newline='') as file:
+        for row in csv.DictReader(file):
+            transforms = row['fwdtransforms'].split(';') + row['invtransforms'].split(';')
+            if row['error'] == '' and all(os.path.exists(path) for path in transforms):
+                done.add((row['fixed'], row['moving']))
+    return done
+
+
+def batch_registration(pairs, save_dir, workers = None, threads = None, a = 'AffineFast', log_path = None, 
+                       **registration_kwargs):
+    """
+    # Description
+        * Register a list of (fixed, moving) image pairs (NIFTI files or DICOM directories)
+        * Pairs are scheduled on a process pool (spawn), every worker gets an explicit ITK thread budget
+          (ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS) so workers x threads does not oversubscribe the node
+        * Forward / inverse transforms are copied to save_dir/<pair hash>/, 
+          every pair is recorded in a CSV log (timings, NCC before / after, transforms, error)
+        * Pairs already registered in the log are skipped, so an interrupted run can be restarted
+
+    Args:
+        pairs (list): (fixed_path, moving_path) tuples
+        save_dir (str): transform output directory
+        workers (int): number of worker processes (None : serial)
+        threads (int): ITK threads per worker process (None : cpu_count // workers), 
+                       ignored when serial (the calling process keeps ITK's default and its environment)
+        a (str): ants type_of_transform
+        log_path (str): log CSV path (None : save_dir/registration_log.csv)
+        registration_kwargs : affine_registration options (cache_dir, roi_flag, roi_threshold, shrink_factor, margin)
+
+    Returns:
+        log_path (str): log CSV path
+
+    example :
+        >>> if __name__ == '__main__':
+        ...     batch_registration([('base/001.nii.gz', 'follow/001.nii.gz')], 'D:/transforms/', 
+        ...                        workers=8, threads=4, roi_flag=True, roi_threshold=-500)
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    if log_path is None:
+        log_path = os.path.join(save_dir, 'registration_log.csv')
+    done = _read_registration_log(log_path)
+    pairs = [(fixed, moving) for fixed, moving in pairs if (fixed, moving) not in done]
+    
+    new_file = not os.path.exists(log_path)
+    with open(log_path, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=REGISTRATION_LOG_FIELDS)
+        if new_file:
+            writer.writeheader()
+        
+        def write_row(row):
+            writer.writerow(row)
+            file.flush()
+        
+        if workers is None or workers <= 1:
+            # serial : ITK is already loaded in this process, its default thread count is used
+            for fixed, moving in tqdm(pairs):
+                write_row(_register_pair(fixed, moving, save_dir, a, registration_kwargs))
+        else:
+            if threads is None:
+                threads = max(1, (os.cpu_count() or 1) // workers)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_registration_worker, initargs=(threads,)) as executor:
+                futures = [executor.submit(_register_pair, fixed, moving, save_dir, a, registration_kwargs)
+                           for fixed, moving in pairs]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    write_row(future.result())
+    return log_path